@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+
+# End-to-end benchmark of bootstrap.py on a synthetic set of local libraries.
+#
+# Archives and single files are served by a local HTTP server, and git/hg libraries point to local repositories, such
+# that no external network access is needed and results are comparable between runs. The following scenarios are
+# timed, each in a separate bootstrap.py process:
+#   cold      - empty destination directory
+#   warm      - all libraries already up to date (no-op)
+#   bump      - one pinned git library moved to another revision
+#   fallback  - empty destination directory, all libraries taken from snapshots on a fallback server (--force-fallback)
+# The results (wall clock times, and per-phase totals from bootstrap.py --trace) are written as JSON.
+
+import argparse
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+EOS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOOTSTRAP_SCRIPT = os.path.join(EOS_DIR, "bootstrap.py")
+
+SCENARIOS = ["cold", "warm", "bump", "fallback"]
+
+# fixed identity and dates, such that generated repositories (and their commit hashes) are reproducible
+GIT_ENVIRONMENT = {
+    "GIT_AUTHOR_NAME": "eos",
+    "GIT_AUTHOR_EMAIL": "eos@localhost",
+    "GIT_AUTHOR_DATE": "2000-01-01T00:00:00Z",
+    "GIT_COMMITTER_NAME": "eos",
+    "GIT_COMMITTER_EMAIL": "eos@localhost",
+    "GIT_COMMITTER_DATE": "2000-01-01T00:00:00Z",
+}
+
+
+def parse_arguments():
+    cl_parser = argparse.ArgumentParser(description="Benchmark bootstrap.py on synthetic local libraries")
+    cl_parser.add_argument("--archives", type=int, default=200, help="number of archive libraries (default: 200)")
+    cl_parser.add_argument("--files", type=int, default=100, help="number of single-file libraries (default: 100)")
+    cl_parser.add_argument("--git", type=int, default=50, help="number of git libraries (default: 50)")
+    cl_parser.add_argument(
+        "--hg", type=int, default=10, help="number of hg libraries (default: 10); ignored if hg is not installed"
+    )
+    cl_parser.add_argument(
+        "--archive-files", type=int, default=20, help="number of files in each archive and repository (default: 20)"
+    )
+    cl_parser.add_argument("--file-size", type=int, default=4, help="size of each generated file in kB (default: 4)")
+    cl_parser.add_argument("--repeat", type=int, default=1, help="number of times each scenario is run (default: 1)")
+    cl_parser.add_argument(
+        "--bootstrap-args",
+        default="",
+        help="additional arguments for bootstrap.py, e.g. '--jobs 8' (given as one string)",
+    )
+    cl_parser.add_argument("--work-dir", help="directory for fixtures and results; a temporary one by default")
+    cl_parser.add_argument("--keep", action="store_true", help="keep the work directory after finishing")
+    cl_parser.add_argument("-o", "--output", help="file to write the JSON results to; printed by default")
+    return cl_parser.parse_args()
+
+
+def _run(command, cwd=None, env=None):
+    subprocess.run(command, cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _capture(command, cwd=None):
+    return subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+
+def _compute_sha1_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for data in iter(lambda: f.read(128 * 1024), b""):
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def _get_file_contents(seed, size):
+    # deterministic, moderately compressible contents
+    line = hashlib.sha1(seed.encode()).hexdigest() + "\n"
+    return (line * (size // len(line) + 1))[:size].encode()
+
+
+def _write_source_files(directory, seed, num_files, file_size):
+    for i in range(num_files):
+        filename = os.path.join(directory, "src", "file" + str(i) + ".c")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(_get_file_contents(seed + str(i), file_size))
+
+
+# -----
+
+
+def create_archive(www_dir, name, num_files, file_size):
+    # returns the filename of a .tar.gz archive with a single top-level directory
+    archive_filename = os.path.join(www_dir, name + "-1.0.tar.gz")
+    with tarfile.open(archive_filename, "w:gz") as tar:
+        for i in range(num_files):
+            data = _get_file_contents(name + str(i), file_size)
+            info = tarfile.TarInfo(name + "-1.0/src/file" + str(i) + ".c")
+            info.size = len(data)
+            info.mtime = 946684800
+            tar.addfile(info, io.BytesIO(data))
+    return archive_filename
+
+
+def create_git_template(work_dir, num_files, file_size):
+    # returns a bare repository with two commits on 'master', and the hashes of both commits
+    src_dir = os.path.join(work_dir, "git-src")
+    env = dict(os.environ, **GIT_ENVIRONMENT)
+    _run(["git", "init", "-q", src_dir], env=env)
+    _run(["git", "-C", src_dir, "symbolic-ref", "HEAD", "refs/heads/master"], env=env)
+    revisions = []
+    for commit in range(2):
+        _write_source_files(src_dir, "git" + str(commit), num_files, file_size)
+        _run(["git", "-C", src_dir, "add", "-A"], env=env)
+        _run(["git", "-C", src_dir, "commit", "-q", "-m", "commit " + str(commit)], env=env)
+        revisions.append(_capture(["git", "-C", src_dir, "rev-parse", "HEAD"]))
+    template_dir = os.path.join(work_dir, "git-template.git")
+    _run(["git", "clone", "-q", "--bare", src_dir, template_dir], env=env)
+    shutil.rmtree(src_dir)
+    return template_dir, revisions
+
+
+def create_hg_template(work_dir, num_files, file_size):
+    # returns a repository with two commits on 'default', and the hashes of both commits
+    template_dir = os.path.join(work_dir, "hg-template")
+    _run(["hg", "init", template_dir])
+    revisions = []
+    for commit in range(2):
+        _write_source_files(template_dir, "hg" + str(commit), num_files, file_size)
+        _run(["hg", "-R", template_dir, "commit", "-q", "-A", "-u", "eos", "-d", "0 0", "-m", "commit " + str(commit)])
+        revisions.append(_capture(["hg", "-R", template_dir, "log", "-r", ".", "--template", "{node}"]))
+    return template_dir, revisions
+
+
+def create_fixtures(cl_args, work_dir, base_url):
+    # Creates all archives, files and repositories, and returns the library list (i.e. the JSON manifest data), as well
+    # as the name and new revision of the library to be bumped.
+    www_dir = os.path.join(work_dir, "www")
+    repo_dir = os.path.join(work_dir, "repos")
+    os.makedirs(www_dir)
+    os.makedirs(repo_dir)
+    libraries = []
+    bump = None
+
+    for i in range(cl_args.archives):
+        name = "archive" + str(i)
+        filename = create_archive(www_dir, name, cl_args.archive_files, cl_args.file_size * 1024)
+        url = base_url + "/www/" + os.path.basename(filename)
+        libraries.append(
+            {"name": name, "source": {"type": "archive", "url": url, "sha1": _compute_sha1_hash(filename)}}
+        )
+
+    for i in range(cl_args.files):
+        name = "file" + str(i)
+        filename = os.path.join(www_dir, name + ".h")
+        with open(filename, "wb") as f:
+            f.write(_get_file_contents(name, cl_args.file_size * 1024))
+        url = base_url + "/www/" + os.path.basename(filename)
+        libraries.append({"name": name, "source": {"type": "file", "url": url, "sha1": _compute_sha1_hash(filename)}})
+
+    # repositories are copies of one template each; every fourth library follows a branch, the others are pinned
+    if cl_args.git > 0:
+        template_dir, revisions = create_git_template(work_dir, cl_args.archive_files, cl_args.file_size * 1024)
+        for i in range(cl_args.git):
+            name = "git" + str(i)
+            url = os.path.join(repo_dir, name + ".git")
+            shutil.copytree(template_dir, url)
+            source = {"type": "git", "url": url}
+            if i % 4 == 3:
+                source["branch-follow"] = "master"
+            else:
+                source["revision"] = revisions[0]
+                if bump is None:
+                    bump = (name, revisions[1])
+            libraries.append({"name": name, "source": source})
+
+    if cl_args.hg > 0:
+        template_dir, revisions = create_hg_template(work_dir, cl_args.archive_files, cl_args.file_size * 1024)
+        for i in range(cl_args.hg):
+            name = "hg" + str(i)
+            url = os.path.join(repo_dir, name)
+            shutil.copytree(template_dir, url)
+            source = {"type": "hg", "url": url}
+            if i % 4 == 3:
+                source["branch-follow"] = "default"
+            else:
+                source["revision"] = revisions[0]
+            libraries.append({"name": name, "source": source})
+
+    return libraries, bump
+
+
+def write_manifest(filename, libraries, bump=None):
+    if bump is not None:
+        name, revision = bump
+        libraries = [
+            dict(obj, source=dict(obj["source"], revision=revision)) if obj["name"] == name else obj
+            for obj in libraries
+        ]
+    with open(filename, "w") as f:
+        json.dump(libraries, f, indent=1)
+
+
+# -----
+
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like most real servers
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(directory):
+    handler = functools.partial(QuietHTTPRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def summarize_trace(trace_filename):
+    # totals per phase (e.g. 'download_file', 'repo: git fetch'), in milliseconds
+    if not os.path.exists(trace_filename):
+        return {}
+    with open(trace_filename) as f:
+        events = json.load(f).get("traceEvents", [])
+    spans = {}
+    for event in events:
+        if event.get("ph") != "X" or event.get("cat") in ["library", "remote check"]:
+            continue
+        key = event["name"] if event["cat"] != "repo" else "repo: " + event["name"]
+        span = spans.setdefault(key, {"count": 0, "total_ms": 0.0})
+        span["count"] += 1
+        span["total_ms"] += event["dur"] / 1000.0
+    for span in spans.values():
+        span["total_ms"] = round(span["total_ms"], 3)
+    return spans
+
+
+def run_bootstrap(manifest_filename, dst_dir, trace_filename, arguments):
+    command = [sys.executable, BOOTSTRAP_SCRIPT, "-a", "-j", manifest_filename, "--trace", trace_filename]
+    command += arguments + [dst_dir]
+    if os.path.exists(trace_filename):
+        os.remove(trace_filename)
+    start = time.perf_counter()
+    proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stdout)
+    return {"seconds": round(seconds, 4), "exit_code": proc.returncode, "spans": summarize_trace(trace_filename)}
+
+
+def get_eos_revision():
+    try:
+        return _capture(["git", "-C", EOS_DIR, "rev-parse", "HEAD"])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cl_args, work_dir):
+    server = start_http_server(work_dir)
+    base_url = "http://127.0.0.1:" + str(server.server_address[1])
+    try:
+        sys.stderr.write("Creating fixtures in " + work_dir + "...\n")
+        libraries, bump = create_fixtures(cl_args, work_dir, base_url)
+        manifest_filename = os.path.join(work_dir, "libraries.json")
+        bumped_manifest_filename = os.path.join(work_dir, "libraries_bumped.json")
+        write_manifest(manifest_filename, libraries)
+        write_manifest(bumped_manifest_filename, libraries, bump)
+
+        arguments = cl_args.bootstrap_args.split()
+        trace_filename = os.path.join(work_dir, "trace.json")
+
+        # the fallback server is a destination directory that snapshots were written to
+        sys.stderr.write("Creating fallback server snapshots...\n")
+        server_dir = os.path.join(work_dir, "server")
+        fallback = run_bootstrap(manifest_filename, server_dir, trace_filename, arguments + ["-s"])
+        if fallback["exit_code"] != 0:
+            raise RuntimeError("creating fallback server snapshots failed")
+        fallback_arguments = arguments + ["--force-fallback", "--fallback-url", base_url + "/server"]
+
+        runs = dict((scenario, []) for scenario in SCENARIOS)
+        dst_dir = os.path.join(work_dir, "dst")
+        fallback_dst_dir = os.path.join(work_dir, "dst_fallback")
+        for repetition in range(cl_args.repeat):
+            sys.stderr.write("Running scenarios (" + str(repetition + 1) + "/" + str(cl_args.repeat) + ")...\n")
+            for directory in [dst_dir, fallback_dst_dir]:
+                if os.path.exists(directory):
+                    shutil.rmtree(directory)
+            runs["cold"].append(run_bootstrap(manifest_filename, dst_dir, trace_filename, arguments))
+            runs["warm"].append(run_bootstrap(manifest_filename, dst_dir, trace_filename, arguments))
+            if bump is not None:
+                runs["bump"].append(run_bootstrap(bumped_manifest_filename, dst_dir, trace_filename, arguments))
+            runs["fallback"].append(
+                run_bootstrap(manifest_filename, fallback_dst_dir, trace_filename, fallback_arguments)
+            )
+    finally:
+        server.shutdown()
+
+    results = {
+        "eos_revision": get_eos_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "bootstrap_args": arguments,
+        "libraries": {
+            "archive": cl_args.archives,
+            "file": cl_args.files,
+            "git": cl_args.git,
+            "hg": cl_args.hg,
+        },
+        "scenarios": {},
+    }
+    for scenario in SCENARIOS:
+        if not runs[scenario]:
+            continue
+        seconds = [run["seconds"] for run in runs[scenario]]
+        fastest = min(runs[scenario], key=lambda run: run["seconds"])
+        results["scenarios"][scenario] = {
+            "seconds": seconds,
+            "min": min(seconds),
+            "median": statistics.median(seconds),
+            "exit_codes": [run["exit_code"] for run in runs[scenario]],
+            "spans": fastest["spans"],  # of the fastest run
+        }
+    return results
+
+
+def main():
+    cl_args = parse_arguments()
+    if cl_args.hg > 0 and shutil.which("hg") is None:
+        sys.stderr.write("hg not found; benchmarking without hg libraries\n")
+        cl_args.hg = 0
+
+    work_dir = os.path.abspath(cl_args.work_dir) if cl_args.work_dir else tempfile.mkdtemp(prefix="eos-benchmark-")
+    if os.path.exists(work_dir) and os.listdir(work_dir):
+        sys.stderr.write("work directory " + work_dir + " is not empty\n")
+        return -1
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        results = run_benchmark(cl_args, work_dir)
+    finally:
+        if not cl_args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if cl_args.output:
+        with open(cl_args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    failed = [s for s, result in results["scenarios"].items() if any(code != 0 for code in result["exit_codes"])]
+    if failed:
+        sys.stderr.write("bootstrap.py FAILED in the following scenarios: " + ", ".join(failed) + "\n")
+        return -1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,77 @@
 #!/usr/bin/env python
 
+import concurrent.futures
+import functools
 import os
 import sys
 
 import eos
+import eos.archive
 import eos.cache
 import eos.cargs
 import eos.constants
+import eos.fallback
 import eos.json
+import eos.scheduler
 import eos.state
 import eos.tools
+import eos.trace
+import eos.util
+
+
+def _bootstrap_buffered(bootstrap, name):
+    # run in a worker thread; collect the log output, such that it does not interleave with other libraries
+    eos.begin_log_buffering()
+    try:
+        success = bootstrap(name)
+    except Exception as e:
+        eos.log_error("bootstrapping library '" + name + "' raised an exception: " + str(e))
+        success = False
+    messages = eos.end_log_buffering()
+    if messages:
+        eos.log("\n".join(messages))
+    return success
+
+
+def _needs_remote_check(obj, force_fallback):
+    # libraries following a branch, and downloads without SHA1 hash, can change without a change to their JSON object;
+    # with '--force-fallback', downloads are not revalidated, since their servers are not to be contacted
+    return eos.json.has_branch_follow_property(obj) or (not force_fallback and eos.json.has_unhashed_download(obj))
+
+
+def _check_remote_libraries(names, library_objects, state, dst_dir, jobs):
+    # returns the set of libraries following a branch that are up to date with their remote branch head, and of
+    # downloads without SHA1 hash that were not modified upstream
+    names = [
+        name
+        for name in names
+        if _needs_remote_check(library_objects[name], False)
+        and state.check_equals(name, library_objects[name])
+        and os.path.exists(os.path.join(dst_dir, name))
+    ]
+
+    def check(name):
+        with eos.trace.span(name, "remote check") as trace_args:
+            if eos.json.has_branch_follow_property(library_objects[name]):
+                trace_args["up_to_date"] = eos.is_branch_follow_library_up_to_date(
+                    library_objects[name], os.path.join(dst_dir, name), state.get_metadata(name)
+                )
+            else:
+                trace_args["up_to_date"] = eos.is_download_up_to_date(library_objects[name], name)
+            return trace_args["up_to_date"]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(check, names))
+    return set(name for name, up_to_date in zip(names, results) if up_to_date)
+
+
+def _get_library_metadata(obj, library_dir, postprocessing_dir):
+    # the checked out revision and working tree status of repositories, and fingerprints of the post-processing steps
+    metadata = eos.get_library_working_state(obj, library_dir) or {}
+    fingerprints = eos.get_postprocess_fingerprints(obj, postprocessing_dir, metadata.get("revision", None))
+    if fingerprints:
+        metadata["postprocess"] = fingerprints
+    return metadata
 
 
 def main(argv):
@@ -22,14 +84,24 @@ def main(argv):
     if not postprocessing_dir:
         postprocessing_dir = os.path.dirname(os.path.abspath(json_filename))
     create_snapshots = cl_args.create_snapshots
-    fallback_server_url = cl_args.fallback_url
+    snapshot_format = cl_args.snapshot_format
+    fallback_server_urls = cl_args.fallback_url
     force_fallback = cl_args.force_fallback
 
     eos.set_verbosity(0 if cl_args.verbose is None else cl_args.verbose)
 
+    if cl_args.trace:
+        eos.trace.enable_tracing()
+
     # initialize tool commands
     eos.tools.initialize_commands()
 
+    if create_snapshots and not eos.archive.is_compression_available(snapshot_format):
+        eos.log_error("snapshot format '" + snapshot_format + "' is not supported on this system")
+        return -1
+
+    eos.util.set_download_segments(cl_args.download_segments, cl_args.download_segments_threshold * 1024 * 1024)
+
     # compile list of libraries to bootstrap
     try:
         requested_library_names = eos.cargs.gather_library_names(cl_args.library, cl_args.library_file)
@@ -43,6 +115,7 @@ def main(argv):
         return -1
 
     all_library_names = eos.json.get_library_names(json_data)
+    library_objects = eos.json.get_library_index(json_data)
 
     # if '--all' is specified, get all library names from the JSON data
     if cl_args.all:
@@ -52,6 +125,21 @@ def main(argv):
         eos.log("No libraries specified to bootstrap; exiting.")
         return -1
 
+    # malformed dependencies or download segments fail the run, like dependency cycles do
+    dependencies = {}
+    valid_segments = True
+    for name in requested_library_names:
+        if name in library_objects:
+            dependencies[name] = eos.json.get_library_dependencies(library_objects[name])
+            valid_segments = eos.json.has_valid_download_segments(library_objects[name]) and valid_segments
+    if None in dependencies.values() or not valid_segments:
+        return -1
+
+    # order the requested libraries by their dependencies; a cycle fails the run before anything is changed
+    ordered_library_names = eos.scheduler.sort_topologically(list(dependencies), dependencies)
+    if ordered_library_names is None:
+        return -1
+
     # create destination directory, if it doesn't exist yet
     try:
         if not os.path.isdir(dst_dir):
@@ -63,60 +151,145 @@ def main(argv):
     # initialize cache directory
     cache_dir = os.path.join(dst_dir, eos.constants.CACHE_DIR_REL)
     eos.cache.init_cache_dir(cache_dir)
+    eos.cache.set_paranoid(cl_args.paranoid)
+    if cl_args.shared_cache:
+        eos.cache.init_shared_cache_dir(cl_args.shared_cache)
+    if cl_args.mirror_cache:
+        eos.cache.init_mirror_cache_dir(cl_args.mirror_cache)
+
+    # rank the fallback mirrors by their latency
+    if fallback_server_urls:
+        eos.fallback.probe_fallback_urls(fallback_server_urls)
 
     # read cached state (if present)
     state_filename = os.path.join(dst_dir, eos.constants.STATE_FILENAME)
-    json_data_state = eos.json.read_file(state_filename)
+    state = eos.state.State(state_filename)
+    with eos.trace.span("read state", "state"):
+        state.read()
 
     # the '--force' option cleans the cached state, such that bootstrapping
     # will commence for each library
     if cl_args.force:
-        json_data_state = []
+        state.clear()
 
     # bootstrap each library, if needed
     libraries_bootstrapped = 0
     libraries_skipped = 0
     failed_libraries = []
 
-    for name in requested_library_names:
-        # skip library, if not found in JSON data
-        if name not in all_library_names:
-            eos.log_warning("unknown library name '" + name + "'")
-            continue
+    libraries_to_bootstrap = []
+    libraries_to_reprocess = {}  # libraries of which only the post-processing changed, with their recorded metadata
 
-        obj = eos.json.get_library_object(json_data, name)
-        library_dir = os.path.join(dst_dir, name)
+    with eos.trace.span("state check", "state", libraries=len(requested_library_names)) as trace_args:
+        # libraries following a branch are checked against their remote branch head, and downloads without SHA1
+        # hash with a conditional request, concurrently
+        up_to_date_remote_libraries = set()
+        if not force_fallback:
+            up_to_date_remote_libraries = _check_remote_libraries(
+                [name for name in requested_library_names if name in library_objects],
+                library_objects,
+                state,
+                dst_dir,
+                max(cl_args.jobs, eos.constants.REMOTE_CHECK_JOBS),
+            )
 
-        # check against state
-        if eos.state.check_equals(json_data_state, name, obj):
-            if (not eos.json.has_branch_follow_property(obj)) and os.path.exists(library_dir):
-                libraries_skipped += 1
-                eos.log_verbose("Cached state for library '" + name + "' matches; skipping bootstrapping")
+        for name in requested_library_names:
+            # skip library, if not found in JSON data
+            if name not in library_objects:
+                eos.log_warning("unknown library name '" + name + "'")
                 continue
 
-        # remove cached state for library
-        eos.state.remove_library(json_data_state, name)
-
-        if eos.bootstrap_library(
-            obj,
-            name,
-            library_dir,
-            postprocessing_dir,
-            create_snapshots,
-            fallback_server_url=fallback_server_url,
-            force_fallback=force_fallback,
-        ):
-            libraries_bootstrapped += 1
+            obj = library_objects[name]
+            library_dir = os.path.join(dst_dir, name)
+
+            # check against state
+            if state.check_equals(name, obj):
+                is_up_to_date = not _needs_remote_check(obj, force_fallback) or name in up_to_date_remote_libraries
+                if is_up_to_date and os.path.exists(library_dir):
+                    metadata = state.get_metadata(name)
+                    fingerprints = eos.get_postprocess_fingerprints(
+                        obj, postprocessing_dir, metadata.get("revision", None)
+                    )
+                    recorded_fingerprints = metadata.get("postprocess", None)
+                    if recorded_fingerprints is None or recorded_fingerprints == fingerprints:
+                        if recorded_fingerprints is None and fingerprints:
+                            # state written by an earlier version; take the post-processing as up to date
+                            state.add_library(obj, metadata=dict(metadata, postprocess=fingerprints))
+                        libraries_skipped += 1
+                        eos.log_verbose("Cached state for library '" + name + "' matches; skipping bootstrapping")
+                        continue
+                    libraries_to_reprocess[name] = metadata
+
+            # remove cached state for library
+            state.remove_library(name)
+
+            libraries_to_bootstrap.append(name)
+        trace_args["skipped"] = libraries_skipped
+
+    # order libraries by their dependencies
+    for name in libraries_to_bootstrap:
+        for dependency in dependencies[name]:
+            if dependency not in library_objects:
+                eos.log_warning("unknown dependency '" + dependency + "' of library '" + name + "'")
+    libraries_to_bootstrap = set(libraries_to_bootstrap)
+    libraries_to_bootstrap = [name for name in ordered_library_names if name in libraries_to_bootstrap]
 
-            # add cached state again
-            json_data_state.append(obj)
+    library_metadata = {}
 
-            # write cached state to disk
-            eos.json.write_file(state_filename, json_data_state)
+    def bootstrap(name):
+        library_dir = os.path.join(dst_dir, name)
+        with eos.trace.span(name, "library") as trace_args:
+            success = None
+            if name in libraries_to_reprocess:
+                # a changed patch or script only; rebuild from the cached source, without network access
+                success = eos.reprocess_library(
+                    library_objects[name], name, library_dir, postprocessing_dir, libraries_to_reprocess[name]
+                )
+                trace_args["reprocessed"] = success is not None
+            if success is None:
+                success = eos.bootstrap_library(
+                    library_objects[name],
+                    name,
+                    library_dir,
+                    postprocessing_dir,
+                    create_snapshots,
+                    snapshot_format=snapshot_format,
+                    fallback_server_urls=fallback_server_urls,
+                    force_fallback=force_fallback,
+                )
+            if success:
+                library_metadata[name] = _get_library_metadata(library_objects[name], library_dir, postprocessing_dir)
+            trace_args["success"] = success
+        return success
+
+    if cl_args.jobs > 1:
+        bootstrap_function = functools.partial(_bootstrap_buffered, bootstrap)
+    else:
+        bootstrap_function = bootstrap
+
+    for name, success in eos.scheduler.run(libraries_to_bootstrap, dependencies, bootstrap_function, cl_args.jobs):
+        if success is None:
+            eos.log_error("skipping library '" + name + "', since one of its dependencies failed to bootstrap")
+            failed_libraries.append(name)
+        elif success:
+            libraries_bootstrapped += 1
+
+            # add cached state again; this is journaled right away, and written in full once at the end
+            state.add_library(library_objects[name], metadata=library_metadata.get(name, None))
         else:
             # TODO: give better errors
             failed_libraries.append(name)
 
+    # write cached state to disk
+    with eos.trace.span("write state", "state"):
+        state.write()
+
+    # persist hashes of verified downloads for the next run
+    eos.cache.write_hash_index()
+
+    if cl_args.trace:
+        eos.trace.write_trace(cl_args.trace)
+
     eos.log(
         "Bootstrapped "
         + str(libraries_bootstrapped)
@@ -1,9 +1,18 @@
+import concurrent.futures
+import mmap
 import os
+import struct
+import subprocess
 import tarfile
+import tempfile
 import shutil
+import threading
 import zipfile
+import zlib
 import eos.cache
 import eos.log
+import eos.tools
+import eos.trace
 
 try:
     import lzma
@@ -12,58 +21,212 @@ try:
 except ImportError:
     LZMA_AVAILABLE = False
 
+# tarfile supports zstd natively from Python 3.14 on
+TARFILE_ZSTD_AVAILABLE = "zst" in tarfile.TarFile.OPEN_METH
 
-def _get_cache_extract_dir(namelist, stem):
-    cache_dir = eos.cache.get_cache_dir()
+BUFFER_SIZE = 1024 * 1024
+ZIP_EXTRACT_JOBS = min(32, os.cpu_count() or 1)
 
-    # get common base directory in file paths, if one exists
-    common_base_dir = os.path.commonprefix(namelist)
 
+def _get_cache_extract_dir(stem):
+    # extract into a fresh directory in the cache, such that concurrent extractions do not collide
+    extraction_dir = tempfile.mkdtemp(prefix=stem + ".", dir=eos.cache.get_cache_dir())
+    os.chmod(extraction_dir, 0o755)
+    return extraction_dir
+
+
+def _get_extracted_dir(extraction_dir):
     # case 1: the archive files have a common base directory
-    extraction_dir = cache_dir
-    extracted_dir = os.path.join(extraction_dir, common_base_dir)
+    entries = os.listdir(extraction_dir)
+    if len(entries) == 1 and os.path.isdir(os.path.join(extraction_dir, entries[0])):
+        return os.path.join(extraction_dir, entries[0])
 
     # case 2: the archive files do not have a common base directory
-    if common_base_dir == "":
-        extraction_dir = os.path.join(cache_dir, stem)
-        extracted_dir = extraction_dir
+    return extraction_dir
 
-    try:
-        os.makedirs(extraction_dir)
-    except os.error:
-        pass
 
-    return extraction_dir, extracted_dir
+def _get_external_decompress_command(compression, filename):
+    # multi-threaded external decompressors, if available
+    if compression == "xz" and eos.tools.command_xz():
+        return [eos.tools.command_xz(), "-d", "-c", "-T0", filename]
+    if compression == "gz" and eos.tools.command_pigz():
+        return [eos.tools.command_pigz(), "-d", "-c", filename]
+    if compression == "bz2" and eos.tools.command_pbzip2():
+        return [eos.tools.command_pbzip2(), "-d", "-c", filename]
+    if compression == "zst" and eos.tools.command_zstd():
+        return [eos.tools.command_zstd(), "-d", "-c", "-q", filename]
+    return None
 
 
-def _decompress_tar_xz_file(filename_src, filename_dst):
-    if not LZMA_AVAILABLE:
-        print("WARNING: Python lzma library not available; extraction of .tar.xz files may not be supported.")
-        print("Installation on Ubuntu:")
-        print("> apt-get install python-lzma")
-        print("Installation on Mac OS X:")
-        print("> brew install xz")
-        print("> pip install pyliblzma")
-        return False
+def _get_external_compress_command(compression):
+    # multi-threaded external compressors, if available; they write to stdout
+    if compression == "xz" and eos.tools.command_xz():
+        return [eos.tools.command_xz(), "-c", "-T0"]
+    if compression == "gz" and eos.tools.command_pigz():
+        return [eos.tools.command_pigz(), "-c"]
+    if compression == "zst" and eos.tools.command_zstd():
+        return [eos.tools.command_zstd(), "-c", "-q", "-T0"]
+    return None
 
-    try:
-        fs = open(filename_src, "rb")
-        if not fs:
-            raise RuntimeError("Opening file " + filename_src + " failed")
-        fd = open(filename_dst, "wb")
-        if not fd:
-            raise RuntimeError("Opening file " + filename_dst + " failed")
-
-        decompressed = lzma.decompress(fs.read())
-        fd.write(decompressed)
-    finally:
-        fs.close()
-        fd.close()
 
-    return True
+def is_compression_available(compression):
+    if compression == "xz":
+        return LZMA_AVAILABLE or eos.tools.command_xz() is not None
+    if compression == "zst":
+        return TARFILE_ZSTD_AVAILABLE or eos.tools.command_zstd() is not None
+    return compression in ["", "gz", "bz2"]
+
+
+def _print_lzma_warning():
+    print("WARNING: Python lzma library not available; extraction of .tar.xz files may not be supported.")
+    print("Installation on Ubuntu:")
+    print("> apt-get install python-lzma")
+    print("Installation on Mac OS X:")
+    print("> brew install xz")
+    print("> pip install pyliblzma")
+
+
+def _extract_tar_file(filename, compression, extraction_dir):
+    # the archive is decompressed as a stream and read sequentially, so neither the compressed nor the decompressed
+    # archive is ever held in memory as a whole, and no intermediate .tar file is written
+    command = _get_external_decompress_command(compression, filename)
+    if command:
+        eos.log_verbose("Decompressing with '" + command[0] + "'", level=2)
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tfile:
+                tfile.extractall(extraction_dir)
+        finally:
+            proc.stdout.close()
+            return_code = proc.wait()
+        if return_code != 0:
+            raise RuntimeError("'" + command[0] + "' exited with code " + str(return_code))
+        return
+
+    if compression == "xz" and not LZMA_AVAILABLE:
+        _print_lzma_warning()
+        raise RuntimeError("lzma not available")
+    if compression == "zst" and not TARFILE_ZSTD_AVAILABLE:
+        raise RuntimeError("zstd not available; neither 'zstd' command nor Python zstd support found")
+
+    with tarfile.open(filename, mode="r|" + compression) as tfile:
+        tfile.extractall(extraction_dir)
 
 
 def extract_file(filename, dst_dir):
+    with eos.trace.span("extract_file", "extract", filename=filename, bytes=os.path.getsize(filename)):
+        return _extract_file(filename, dst_dir)
+
+
+def _get_zip_member_path(extraction_dir, member):
+    # like ZipFile.extract(), strip absolute paths, drive letters and '..' components
+    arcname = member.filename.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ("", os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid_path_parts)
+    return os.path.join(extraction_dir, arcname) if arcname else None
+
+
+def _get_zip_member_data_offset(data, member):
+    # the member data follows the local file header, whose variable-length fields can differ from the central directory
+    offset = member.header_offset
+    if data[offset : offset + 4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("bad local file header of '" + member.filename + "'")
+    filename_length, extra_length = struct.unpack("<HH", data[offset + 26 : offset + 30])
+    return offset + 30 + filename_length + extra_length
+
+
+def _write_zip_member_data(data, member, f):
+    # decompresses straight from the memory-mapped archive; zlib releases the GIL while inflating
+    start = _get_zip_member_data_offset(data, member)
+    crc = 0
+    with data[start : start + member.compress_size] as compressed:
+        if member.compress_type == zipfile.ZIP_STORED:
+            for offset in range(0, len(compressed), BUFFER_SIZE):
+                with compressed[offset : offset + BUFFER_SIZE] as chunk:
+                    crc = zlib.crc32(chunk, crc)
+                    f.write(chunk)
+        else:
+            # the input is fed in bounded slices, since the unconsumed tail of each call is a copy of the remaining
+            # input; the output of each slice is bounded as well, for highly compressed data
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            for offset in range(0, len(compressed), BUFFER_SIZE):
+                with compressed[offset : offset + BUFFER_SIZE] as chunk:
+                    tail = chunk
+                    while tail:
+                        output = decompressor.decompress(tail, BUFFER_SIZE)
+                        tail = decompressor.unconsumed_tail
+                        crc = zlib.crc32(output, crc)
+                        f.write(output)
+            output = decompressor.flush()
+            crc = zlib.crc32(output, crc)
+            f.write(output)
+    if crc != member.CRC:
+        raise zipfile.BadZipFile("bad CRC-32 for file '" + member.filename + "'")
+
+
+def _extract_zip_member(zfile, data, member, path):
+    with open(path, "wb") as f:
+        if member.file_size > 0 and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, member.file_size)
+        if member.compress_type in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED] and not member.flag_bits & 0x1:
+            _write_zip_member_data(data, member, f)
+        else:
+            # other compression methods, or encrypted members
+            with zfile.open(member) as source:
+                shutil.copyfileobj(source, f, BUFFER_SIZE)
+
+
+def _extract_zip_members(zfile, data, members, members_lock):
+    # each worker takes the next member until none are left, which balances the load without a task per member
+    while True:
+        with members_lock:
+            item = next(members, None)
+        if item is None:
+            return
+        _extract_zip_member(zfile, data, *item)
+
+
+def _extract_zip_file(filename, extraction_dir):
+    # Members are extracted concurrently by a thread pool, reading from the memory-mapped archive. Directories are
+    # created up front, such that each member can be written directly to its final location.
+    with zipfile.ZipFile(filename) as zfile, open(filename, "rb") as f:
+        members = []
+        directories = set()
+        for member in zfile.infolist():
+            path = _get_zip_member_path(extraction_dir, member)
+            if path is None:
+                continue
+            if member.is_dir():
+                directories.add(path)
+            else:
+                directories.add(os.path.dirname(path))
+                members.append((member, path))
+        for directory in sorted(directories):
+            os.makedirs(directory, exist_ok=True)
+        if not members:
+            return
+
+        # largest members first, for better load balancing
+        members.sort(key=lambda m: m[0].file_size, reverse=True)
+        jobs = min(ZIP_EXTRACT_JOBS, len(members))
+        members_lock = threading.Lock()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as data:
+            if jobs == 1:
+                _extract_zip_members(zfile, data, iter(members), members_lock)
+                return
+            members = iter(members)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(_extract_zip_members, zfile, data, members, members_lock) for _ in range(jobs)
+                ]
+                for future in futures:
+                    future.result()
+
+
+def _extract_file(filename, dst_dir):
     assert not os.path.exists(dst_dir)
 
     eos.log_verbose("Extracting file " + filename + " to " + dst_dir)
@@ -76,38 +239,39 @@ def extract_file(filename, dst_dir):
             eos.log_error("file '" + filename + "' is not expected zip file")
             return False
 
-        zfile = zipfile.ZipFile(filename)
-        extraction_dir, extracted_dir = _get_cache_extract_dir(zfile.namelist(), stem)
-        zfile.extractall(extraction_dir)
-        zfile.close()
+        extraction_dir = _get_cache_extract_dir(stem)
+        try:
+            _extract_zip_file(filename, extraction_dir)
+        except (zipfile.BadZipFile, zlib.error, OSError, RuntimeError) as e:
+            eos.log_error("extraction of zip file '" + filename + "' failed (" + str(e) + ")")
+            shutil.rmtree(extraction_dir)
+            return False
 
-    elif extension == ".tar" or extension == ".gz" or extension == ".bz2" or extension == ".xz":
-        # special case .tar.xz format: uncompress to .tar file first
-        if extension == ".xz":
+    elif extension in [".tar", ".gz", ".bz2", ".xz", ".zst"]:
+        # .tar.xz and .tar.zst files need to have the .tar extension in the stem
+        if extension in [".xz", ".zst"]:
             stem2, extension2 = os.path.splitext(os.path.basename(stem))
             if extension2 != ".tar":
                 eos.log_error("unable to extract file " + filename)
                 return False
-            tar_filename = os.path.join(os.path.dirname(filename), stem)
-            if not _decompress_tar_xz_file(filename, tar_filename):
-                return False
-            filename = tar_filename
 
-        if not tarfile.is_tarfile(filename):
-            eos.log_error("file '" + filename + "' is not expected tar file")
+        compression = extension[1:] if extension != ".tar" else ""
+        extraction_dir = _get_cache_extract_dir(stem)
+        try:
+            _extract_tar_file(filename, compression, extraction_dir)
+        except (tarfile.TarError, EOFError, OSError, RuntimeError) as e:
+            eos.log_error("file '" + filename + "' is not expected tar file (" + str(e) + ")")
+            shutil.rmtree(extraction_dir)
             return False
 
-        tfile = tarfile.open(filename)
-        extraction_dir, extracted_dir = _get_cache_extract_dir(tfile.getnames(), stem)
-        tfile.extractall(extraction_dir)
-        tfile.close()
-
     else:
         eos.log_error("unknown archive format '" + extension + "'")
         return False
 
     # rename extracted directory to target directory
-    shutil.move(extracted_dir, dst_dir)
+    shutil.move(_get_extracted_dir(extraction_dir), dst_dir)
+    if os.path.exists(extraction_dir):
+        shutil.rmtree(extraction_dir)
 
     if not os.path.isdir(dst_dir):
         eos.log("expected destination directory '" + dst_dir + "' does not exist; error during archive extraction")
@@ -116,7 +280,28 @@ def extract_file(filename, dst_dir):
     return True
 
 
-def create_archive_from_directory(src_dir_name, archive_name, delete_existing_archive=False):
+def _write_tar_file(src_dir_name, archive_name, compression):
+    command = _get_external_compress_command(compression)
+    if not command:
+        with tarfile.open(archive_name, "w:" + compression) as tar:
+            tar.add(src_dir_name, arcname=os.path.basename(src_dir_name))
+        return
+
+    # the uncompressed archive is streamed through the compressor, which writes to the archive file
+    eos.log_verbose("Compressing with '" + command[0] + "'", level=2)
+    with open(archive_name, "wb") as f:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                tar.add(src_dir_name, arcname=os.path.basename(src_dir_name))
+        finally:
+            proc.stdin.close()
+            return_code = proc.wait()
+    if return_code != 0:
+        raise RuntimeError("'" + command[0] + "' exited with code " + str(return_code))
+
+
+def create_archive_from_directory(src_dir_name, archive_name, delete_existing_archive=False, compression="gz"):
     if delete_existing_archive and os.path.exists(archive_name):
         eos.log_verbose("Removing snapshot file " + archive_name + " before creating new one")
         os.remove(archive_name)
@@ -125,5 +310,12 @@ def create_archive_from_directory(src_dir_name, archive_name, delete_existing_ar
     if not os.path.isdir(archive_dir):
         os.mkdir(archive_dir)
 
-    with tarfile.open(archive_name, "w:gz") as tar:
-        tar.add(src_dir_name, arcname=os.path.basename(src_dir_name))
+    # write to a temporary file first, such that an incomplete archive is never served or extracted
+    partial_archive_name = archive_name + ".part"
+    try:
+        _write_tar_file(src_dir_name, partial_archive_name, compression)
+    except:
+        if os.path.exists(partial_archive_name):
+            os.remove(partial_archive_name)
+        raise
+    os.replace(partial_archive_name, archive_name)
@@ -7,17 +7,112 @@ import eos.constants
 import eos.fallback
 import eos.log
 import eos.post
+import eos.pristine
 import eos.repo
+import eos.trace
 import eos.util
 
 
+def _create_snapshot(src_type, name, library_dir, snapshot_name, snapshot_format):
+    # Snapshots of repositories are keyed by the checked out commit, such that an unchanged repository is not archived
+    # again; only the snapshot index entry (mapping the snapshot name to the archive) is updated.
+    working_state = eos.repo.get_working_state(src_type, library_dir)
+    commit = working_state["revision"] if working_state else None
+    if commit:
+        snapshot_archive_name = name + "_" + commit + ".tar." + snapshot_format
+    else:
+        snapshot_archive_name = snapshot_name + ".tar." + snapshot_format
+    snapshot_archive_filename = os.path.join(eos.cache.get_snapshot_dir(), snapshot_archive_name)
+    previous_snapshot_archive_name = eos.cache.get_snapshot_index().get(snapshot_name, None)
+
+    if commit and os.path.exists(snapshot_archive_filename):
+        eos.log_verbose("Snapshot of '" + name + "' at commit " + commit + " already exists; not creating it again")
+    else:
+        eos.log("Creating snapshot of '" + name + "' repository...")
+        eos.log_verbose("Snapshot will be written to " + snapshot_archive_filename)
+        with eos.trace.span("create snapshot", "snapshot", filename=snapshot_archive_filename) as trace_args:
+            eos.archive.create_archive_from_directory(
+                library_dir, snapshot_archive_filename, True, compression=snapshot_format
+            )
+            trace_args["bytes"] = os.path.getsize(snapshot_archive_filename)
+    eos.cache.set_snapshot_index_entry(snapshot_name, snapshot_archive_name)
+
+    # clients without snapshot index look for '<snapshot name>.tar.gz'
+    legacy_snapshot_archive_name = snapshot_name + ".tar.gz"
+
+    # remove the snapshot of the previous commit (e.g. of a followed branch), unless it is still referenced
+    if (
+        previous_snapshot_archive_name
+        and previous_snapshot_archive_name not in [snapshot_archive_name, legacy_snapshot_archive_name]
+        and previous_snapshot_archive_name not in eos.cache.get_snapshot_index().values()
+    ):
+        previous_snapshot_archive_filename = os.path.join(eos.cache.get_snapshot_dir(), previous_snapshot_archive_name)
+        if os.path.exists(previous_snapshot_archive_filename):
+            eos.log_verbose("Removing superseded snapshot file " + previous_snapshot_archive_filename)
+            os.remove(previous_snapshot_archive_filename)
+
+    # the legacy name points to the same archive, for fallback clients that only know that name
+    if snapshot_format == "gz" and snapshot_archive_name != legacy_snapshot_archive_name:
+        eos.cache.link_or_copy(
+            snapshot_archive_filename, os.path.join(eos.cache.get_snapshot_dir(), legacy_snapshot_archive_name)
+        )
+
+
+def _get_postprocess_file(post, postprocessing_dir):
+    post_file = post.get("file", None)
+    # If we have a postprocessing directory specified, make it an absolute path
+    if post_file and postprocessing_dir:
+        post_file = os.path.join(postprocessing_dir, post_file)
+    return post_file
+
+
+def _postprocess_library(json_obj, name, library_dir, postprocessing_dir):
+    postprocess_keys = sorted([key for key in json_obj if key.startswith("postprocess")])
+
+    for postprocess_key in postprocess_keys:
+        post = json_obj.get(postprocess_key, None)
+        eos.log_verbose("Post-processing step '%s'" % postprocess_key)
+
+        post_type = post.get("type", None)
+        if not post_type:
+            eos.log_error("postprocessing object for library '" + name + "' must have a 'type'")
+            return False
+
+        post_file = _get_postprocess_file(post, postprocessing_dir)
+        if not post_file:
+            eos.log_error("postprocessing object for library '" + name + "' must have a 'file'")
+            return False
+
+        if post_type not in ["patch", "script"]:
+            eos.log_error("unknown postprocessing type for library '" + name + "'")
+            return False
+
+        with eos.trace.span(postprocess_key, "postprocess", type=post_type, file=post_file):
+            if post_type == "patch":
+                pnum = post.get("pnum", 2)
+                # Try to apply patch
+                if not eos.post.apply_patch(name, library_dir, post_file, pnum):
+                    eos.log_error("patch application of " + post_file + " failed for library '" + name + "'")
+                    return False
+            elif post_type == "script":
+                # Replace variable strings with contents
+                post_file = post_file.replace("$LIBRARY_DIR", os.path.abspath(library_dir))
+                # Try to run script
+                if not eos.post.run_script(name, post_file):
+                    eos.log_error("script execution of " + post_file + " failed for library '" + name + "'")
+                    return False
+
+    return True
+
+
 def bootstrap_library(
     json_obj,
     name,
     library_dir,
     postprocessing_dir,
     create_snapshots=False,
-    fallback_server_url=None,
+    snapshot_format="gz",
+    fallback_server_urls=None,
     force_fallback=False,
 ):
     eos.log("Bootstrapping library '" + name + "' to " + library_dir)
@@ -45,12 +140,11 @@ def bootstrap_library(
         return False
 
     def get_from_fallback(filename, relative_src_dir, download_dir, extract_file=True):
-        if fallback_server_url is None:
+        if not fallback_server_urls:
             return False
-        eos.log("Downloading from fallback URL %s" % fallback_server_url)
         relative_src_dir = eos.util.convert_to_forward_slashes(relative_src_dir)
-        success = eos.fallback.download_from_fallback_url(
-            fallback_server_url,
+        success = eos.fallback.download_from_fallback_urls(
+            fallback_server_urls,
             filename,
             relative_src_dir=relative_src_dir,
             download_dir=download_dir if extract_file else library_dir,
@@ -73,25 +167,27 @@ def bootstrap_library(
                 extract_file=False,
             )
 
-            # download file
-        download_filename = eos.util.download_file(src_url, eos.cache.get_archive_dir(name), sha1_hash, user_agent)
+        # download file
+        download_filename = eos.util.download_file(
+            src_url, eos.cache.get_archive_dir(name), sha1_hash, user_agent, segments=src.get("segments", None)
+        )
         if download_filename == "":
             eos.log_error("downloading of file for '" + name + "' from " + src_url + " failed")
             return get_from_fallback(
-                os.path.basename(download_filename),
+                eos.util.get_filename_from_url(eos.util.sanitize_url(src_url)),
                 eos.cache.get_relative_archive_dir(name),
                 eos.cache.get_archive_dir(name),
                 extract_file=False,
             )
 
-            if os.path.exists(library_dir):
-                shutil.rmtree(library_dir)
+        if os.path.exists(library_dir):
+            shutil.rmtree(library_dir)
 
         # copy file
         try:
             os.mkdir(library_dir)
             filename_rel = os.path.basename(download_filename)
-            shutil.copyfile(download_filename, os.path.join(library_dir, filename_rel))
+            eos.pristine.clone_file(download_filename, os.path.join(library_dir, filename_rel))
         except:
             eos.log_error("copying of file for '" + download_filename + "' failed")
             if os.path.exists(library_dir):
@@ -110,24 +206,26 @@ def bootstrap_library(
                 eos.cache.get_archive_dir(name),
             )
 
-            # download archive file
-        download_filename = eos.util.download_file(src_url, eos.cache.get_archive_dir(name), sha1_hash, user_agent)
+        # download archive file
+        download_filename = eos.util.download_file(
+            src_url, eos.cache.get_archive_dir(name), sha1_hash, user_agent, segments=src.get("segments", None)
+        )
         if download_filename == "":
             eos.log_error("downloading of file for '" + name + "' from " + src_url + " failed")
             return get_from_fallback(
-                os.path.basename(download_filename),
+                eos.util.get_filename_from_url(eos.util.sanitize_url(src_url)),
                 eos.cache.get_relative_archive_dir(name),
                 eos.cache.get_archive_dir(name),
             )
 
-            if os.path.exists(library_dir):
-                shutil.rmtree(library_dir)
+        if os.path.exists(library_dir):
+            shutil.rmtree(library_dir)
 
-        # extract archive file
-        if not eos.archive.extract_file(download_filename, library_dir):
+        # extract archive file (into the pristine tree in the cache, from which the library directory is materialized)
+        if not eos.pristine.extract_archive(download_filename, name, library_dir):
             eos.log_error("extraction of file for '" + download_filename + "' failed")
             return get_from_fallback(
-                os.path.basename(download_filename),
+                eos.util.get_filename_from_url(eos.util.sanitize_url(src_url)),
                 eos.cache.get_relative_archive_dir(name),
                 eos.cache.get_archive_dir(name),
             )
@@ -142,19 +240,31 @@ def bootstrap_library(
             eos.log_error("cannot specify both branch (to follow) and revision for repository '" + name + "'")
             return False
 
-        # filename for reading/writing snapshots
-        snapshot_archive_name = name + ".tar.gz"
+        # name for reading/writing snapshots; the snapshot index maps it to the archive filename
+        snapshot_name = name
         if revision is not None:
-            snapshot_archive_name = name + "_" + revision + ".tar.gz"  # add the revision number, if present
+            snapshot_name = name + "_" + revision  # add the revision number, if present
 
         # clone or update repository
         if not force_fallback:
-            update_repo_success = eos.repo.update_state(src_type, src_url, name, library_dir, branch, revision)
+            update_repo_success = eos.repo.update_state(
+                src_type,
+                src_url,
+                name,
+                library_dir,
+                branch,
+                revision,
+                depth=src.get("depth", None),
+                clone_filter=src.get("filter", None),
+                single_branch=src.get("single-branch", False),
+            )
         if force_fallback or not update_repo_success:
             if not force_fallback:
                 eos.log_error("updating repository state for '" + name + " failed")
             fallback_success = get_from_fallback(
-                snapshot_archive_name, eos.cache.get_relative_snapshot_dir(), eos.cache.get_snapshot_dir()
+                lambda fallback_url: eos.fallback.get_snapshot_filename(fallback_url, snapshot_name),
+                eos.cache.get_relative_snapshot_dir(),
+                eos.cache.get_snapshot_dir(),
             )
             if not fallback_success:
                 return False
@@ -165,49 +275,99 @@ def bootstrap_library(
 
         # optionally create snapshot
         if create_snapshots:
-            eos.log("Creating snapshot of '" + name + "' repository...")
-            snapshot_archive_filename = os.path.join(eos.cache.get_snapshot_dir(), snapshot_archive_name)
-            eos.log_verbose("Snapshot will be written to " + snapshot_archive_filename)
-            eos.archive.create_archive_from_directory(library_dir, snapshot_archive_filename, revision is None)
+            _create_snapshot(src_type, name, library_dir, snapshot_name, snapshot_format)
 
     # post-process library
+    return _postprocess_library(json_obj, name, library_dir, postprocessing_dir)
+
+
+def _restore_pristine_source(src, name, library_dir, revision):
+    # Restores the unprocessed library from local data only: the cached download, or the recorded repository commit.
+    # Returns False if that is not possible, e.g. for SVN, or if the download is not in the cache (anymore).
+    src_type = src.get("type", None)
+    if src_type in ["file", "archive"]:
+        url = eos.util.sanitize_url(src.get("url", None) or "")
+        download_filename = os.path.join(eos.cache.get_archive_dir(name), eos.util.get_filename_from_url(url))
+        sha1_hash = src.get("sha1", None)
+        if not os.path.exists(download_filename) or (
+            sha1_hash and eos.cache.get_verified_hash(download_filename) != sha1_hash
+        ):
+            return False
+
+        if os.path.exists(library_dir):
+            shutil.rmtree(library_dir)
+        if src_type == "archive":
+            return eos.pristine.extract_archive(download_filename, name, library_dir)
+        os.mkdir(library_dir)
+        eos.pristine.clone_file(download_filename, os.path.join(library_dir, os.path.basename(download_filename)))
+        return True
+
+    if src_type in ["git", "hg"] and revision:
+        return eos.repo.restore_revision(src_type, library_dir, revision)
+    return False
+
+
+def reprocess_library(json_obj, name, library_dir, postprocessing_dir, metadata):
+    # Re-runs the post-processing of a library whose post-processing steps changed, but whose source did not. The
+    # library is restored from local data first, without network access. Returns None if that is not possible, in which
+    # case the library has to be bootstrapped as usual.
+    eos.log("Post-processing of library '" + name + "' changed; rebuilding it from its cached source")
+    try:
+        restored = _restore_pristine_source(
+            json_obj.get("source", {}), name, library_dir, metadata.get("revision", None)
+        )
+    except (IOError, OSError) as e:
+        eos.log_warning("restoring library '" + name + "' from its cached source failed: " + str(e))
+        restored = False
+    if not restored:
+        eos.log_verbose("Cached source of library '" + name + "' is not available; bootstrapping it again")
+        return None
+    return _postprocess_library(json_obj, name, library_dir, postprocessing_dir)
 
+
+def get_postprocess_fingerprints(json_obj, postprocessing_dir, source_revision):
+    # one fingerprint per post-processing step, in the order of the steps
     postprocess_keys = sorted([key for key in json_obj if key.startswith("postprocess")])
+    return [
+        eos.post.get_step_fingerprint(
+            json_obj[key], _get_postprocess_file(json_obj[key], postprocessing_dir), source_revision
+        )
+        for key in postprocess_keys
+    ]
 
-    for postprocess_key in postprocess_keys:
-        post = json_obj.get(postprocess_key, None)
-        eos.log_verbose("Post-processing step '%s'" % postprocess_key)
 
-        post_type = post.get("type", None)
-        if not post_type:
-            eos.log_error("postprocessing object for library '" + name + "' must have a 'type'")
-            return False
+def get_library_working_state(json_obj, library_dir):
+    # for repositories, returns the checked out revision and a hash of the working tree status; None otherwise
+    src_type = json_obj.get("source", {}).get("type", None)
+    if src_type not in ["git", "hg"]:
+        return None
+    return eos.repo.get_working_state(src_type, library_dir)
 
-        post_file = post.get("file", None)
-        if not post_file:
-            eos.log_error("postprocessing object for library '" + name + "' must have a 'file'")
-            return False
 
-        if post_type not in ["patch", "script"]:
-            eos.log_error("unknown postprocessing type for library '" + name + "'")
-            return False
+def is_branch_follow_library_up_to_date(json_obj, library_dir, working_state):
+    # A library following a branch is up to date if the remote branch head is still the commit recorded after the
+    # last bootstrapping, and the working tree is unchanged since then. The remote check is a cheap 'ls-remote' or
+    # 'hg identify' instead of a full fetch/pull.
+    src = json_obj.get("source", {})
+    src_type = src.get("type", None)
+    recorded_revision = working_state.get("revision", None) if working_state else None
+    if src_type not in ["git", "hg"] or not recorded_revision:
+        return False
 
-        # If we have a postprocessing directory specified, make it an absolute path
-        if postprocessing_dir:
-            post_file = os.path.join(postprocessing_dir, post_file)
+    remote_revision = eos.repo.get_remote_revision(src_type, src.get("url", None), src.get("branch-follow", None))
+    if not remote_revision or not recorded_revision.startswith(remote_revision):
+        return False
 
-        if post_type == "patch":
-            pnum = post.get("pnum", 2)
-            # Try to apply patch
-            if not eos.post.apply_patch(name, library_dir, post_file, pnum):
-                eos.log_error("patch application of " + post_file + " failed for library '" + name + "'")
-                return False
-        elif post_type == "script":
-            # Replace variable strings with contents
-            post_file = post_file.replace("$LIBRARY_DIR", os.path.abspath(library_dir))
-            # Try to run script
-            if not eos.post.run_script(name, post_file):
-                eos.log_error("script execution of " + post_file + " failed for library '" + name + "'")
-                return False
+    # the recorded metadata also holds the post-processing fingerprints
+    current_working_state = get_library_working_state(json_obj, library_dir)
+    return current_working_state is not None and all(
+        working_state.get(key, None) == value for key, value in current_working_state.items()
+    )
 
-    return True
+
+def is_download_up_to_date(json_obj, name):
+    # A file or archive without SHA1 hash is up to date if a conditional request reports no modification upstream.
+    src = json_obj.get("source", {})
+    return not eos.util.is_download_modified(
+        src.get("url", None), eos.cache.get_archive_dir(name), src.get("user-agent", None)
+    )
@@ -1,16 +1,34 @@
+import hashlib
 import os
+import shutil
+import threading
 
 import eos.constants
+import eos.json
+import eos.util
 
 CACHE_DIR = None
 ARCHIVE_DIR = None
 SNAPSHOT_DIR = None
+PRISTINE_DIR = None
+SHARED_CACHE_DIR = None
+MIRROR_CACHE_DIR = None
+
+HASH_INDEX = None
+HASH_INDEX_FILENAME = None
+HASH_INDEX_MODIFIED = False
+HASH_INDEX_LOCK = threading.Lock()
+PARANOID = False
+
+SNAPSHOT_INDEX = None
+SNAPSHOT_INDEX_LOCK = threading.Lock()
 
 
 def init_cache_dir(cache_dir):
     global CACHE_DIR
     global ARCHIVE_DIR
     global SNAPSHOT_DIR
+    global PRISTINE_DIR
     assert cache_dir
 
     CACHE_DIR = cache_dir
@@ -25,6 +43,12 @@ def init_cache_dir(cache_dir):
     if not os.path.isdir(SNAPSHOT_DIR):
         os.mkdir(SNAPSHOT_DIR)
 
+    PRISTINE_DIR = os.path.join(CACHE_DIR, eos.constants.PRISTINE_SUBDIR_REL)
+    if not os.path.isdir(PRISTINE_DIR):
+        os.mkdir(PRISTINE_DIR)
+
+    _read_hash_index(os.path.join(CACHE_DIR, eos.constants.HASH_INDEX_FILENAME))
+
 
 def get_cache_dir():
     return CACHE_DIR
@@ -40,6 +64,12 @@ def get_snapshot_dir():
     return SNAPSHOT_DIR
 
 
+def get_pristine_dir(library_name=None):
+    if library_name is None:
+        return PRISTINE_DIR
+    return os.path.join(PRISTINE_DIR, library_name)
+
+
 def get_relative_archive_dir(library_name=None):
     if library_name is None:
         return os.path.join(eos.constants.CACHE_DIR_REL, eos.constants.ARCHIVE_SUBDIR_REL)
@@ -48,3 +78,191 @@ def get_relative_archive_dir(library_name=None):
 
 def get_relative_snapshot_dir():
     return os.path.join(eos.constants.CACHE_DIR_REL, eos.constants.SNAPSHOT_SUBDIR_REL)
+
+
+# -----
+# The snapshot index, in the snapshot directory, maps snapshot names (the library name, plus '_<revision>' if pinned) to
+# the snapshot archive filenames. Clients read it from the fallback server to know which file, in which format, to fetch.
+
+
+def get_snapshot_index():
+    global SNAPSHOT_INDEX
+    with SNAPSHOT_INDEX_LOCK:
+        if SNAPSHOT_INDEX is None:
+            SNAPSHOT_INDEX = eos.json.read_file(os.path.join(SNAPSHOT_DIR, eos.constants.SNAPSHOT_INDEX_FILENAME))
+            if not isinstance(SNAPSHOT_INDEX, dict):
+                SNAPSHOT_INDEX = {}
+        return dict(SNAPSHOT_INDEX)
+
+
+def set_snapshot_index_entry(snapshot_name, filename):
+    # the index is written right away, since a fallback server may serve it while snapshots are still being created
+    get_snapshot_index()
+    with SNAPSHOT_INDEX_LOCK:
+        if SNAPSHOT_INDEX.get(snapshot_name, None) == filename:
+            return
+        SNAPSHOT_INDEX[snapshot_name] = filename
+        eos.json.write_file_atomic(os.path.join(SNAPSHOT_DIR, eos.constants.SNAPSHOT_INDEX_FILENAME), SNAPSHOT_INDEX)
+
+
+# -----
+# The hash index maps files in the cache to their verified SHA1 hash, keyed by (size, mtime_ns, inode), such that
+# unchanged files do not need to be hashed again on each run.
+
+
+def set_paranoid(paranoid):
+    # paranoid mode ignores the hash index, i.e. always computes file hashes
+    global PARANOID
+    PARANOID = paranoid
+
+
+def _read_hash_index(filename):
+    global HASH_INDEX
+    global HASH_INDEX_FILENAME
+    global HASH_INDEX_MODIFIED
+
+    HASH_INDEX_FILENAME = filename
+    HASH_INDEX = eos.json.read_file(filename)
+    if not isinstance(HASH_INDEX, dict):
+        HASH_INDEX = {}
+    HASH_INDEX_MODIFIED = False
+
+
+def _get_stat_key(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def get_verified_hash(filename):
+    if PARANOID or HASH_INDEX is None:
+        return None
+
+    with HASH_INDEX_LOCK:
+        entry = HASH_INDEX.get(os.path.abspath(filename), None)
+    try:
+        if entry and entry.get("stat", None) == _get_stat_key(filename):
+            return entry.get("sha1", None)
+    except OSError:
+        pass
+    return None
+
+
+def set_verified_hash(filename, sha1_hash):
+    global HASH_INDEX_MODIFIED
+    if HASH_INDEX is None:
+        return
+
+    try:
+        entry = {"stat": _get_stat_key(filename), "sha1": sha1_hash}
+    except OSError:
+        return
+    with HASH_INDEX_LOCK:
+        HASH_INDEX[os.path.abspath(filename)] = entry
+        HASH_INDEX_MODIFIED = True
+
+
+def write_hash_index():
+    global HASH_INDEX_MODIFIED
+    if HASH_INDEX is None or not HASH_INDEX_MODIFIED:
+        return
+
+    with HASH_INDEX_LOCK:
+        # drop entries of files that do not exist anymore
+        for filename in [f for f in HASH_INDEX if not os.path.exists(f)]:
+            del HASH_INDEX[filename]
+        eos.json.write_file_atomic(HASH_INDEX_FILENAME, HASH_INDEX)
+        HASH_INDEX_MODIFIED = False
+
+
+# -----
+# The shared cache is a machine-wide, content-addressed store of downloaded files, keyed by their SHA1 hash.
+
+
+def init_shared_cache_dir(shared_cache_dir):
+    global SHARED_CACHE_DIR
+    assert shared_cache_dir
+
+    SHARED_CACHE_DIR = os.path.abspath(shared_cache_dir)
+    if not os.path.isdir(SHARED_CACHE_DIR):
+        os.makedirs(SHARED_CACHE_DIR)
+
+
+def get_shared_cache_dir():
+    return SHARED_CACHE_DIR
+
+
+def _get_shared_cache_filename(sha1_hash):
+    return os.path.join(SHARED_CACHE_DIR, sha1_hash[:2], sha1_hash)
+
+
+def link_or_copy(src_filename, dst_filename):
+    # hard-links the file where possible, and copies it otherwise; writes to a temporary file next to the destination
+    # first (unique per process and thread), such that the destination is replaced atomically
+    if os.path.exists(dst_filename) and os.path.samefile(src_filename, dst_filename):
+        return
+    tmp_filename = dst_filename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    try:
+        try:
+            os.link(src_filename, tmp_filename)
+        except OSError:
+            shutil.copyfile(src_filename, tmp_filename)
+        os.replace(tmp_filename, dst_filename)
+    finally:
+        # renaming onto another link to the same file (linked concurrently) leaves the temporary file in place
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def fetch_from_shared_cache(sha1_hash, filename):
+    if SHARED_CACHE_DIR is None or not eos.util.is_sha1(sha1_hash):
+        return False
+
+    shared_filename = _get_shared_cache_filename(sha1_hash)
+    if not os.path.exists(shared_filename):
+        return False
+
+    try:
+        link_or_copy(shared_filename, filename)
+    except (IOError, OSError):
+        eos.log_warning("could not materialize " + filename + " from shared cache")
+        return False
+    return True
+
+
+def add_to_shared_cache(sha1_hash, filename):
+    if SHARED_CACHE_DIR is None or not eos.util.is_sha1(sha1_hash):
+        return
+
+    shared_filename = _get_shared_cache_filename(sha1_hash)
+    if os.path.exists(shared_filename):
+        return
+
+    try:
+        os.makedirs(os.path.dirname(shared_filename), exist_ok=True)
+        link_or_copy(filename, shared_filename)
+    except (IOError, OSError):
+        eos.log_warning("could not add " + filename + " to shared cache")
+
+
+# -----
+# The mirror cache is a machine-wide store of bare repository mirrors, one per repository URL.
+
+
+def init_mirror_cache_dir(mirror_cache_dir):
+    global MIRROR_CACHE_DIR
+    assert mirror_cache_dir
+
+    MIRROR_CACHE_DIR = os.path.abspath(mirror_cache_dir)
+    if not os.path.isdir(MIRROR_CACHE_DIR):
+        os.makedirs(MIRROR_CACHE_DIR)
+
+
+def get_mirror_cache_dir():
+    return MIRROR_CACHE_DIR
+
+
+def get_mirror_dir(repo_type, url):
+    # the last URL component keeps the directory recognizable; the hash makes it unique
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    repo_name = os.path.basename(url.rstrip("/")) or "repo"
+    return os.path.join(MIRROR_CACHE_DIR, repo_type, repo_name + "-" + url_hash)
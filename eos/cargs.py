@@ -1,5 +1,27 @@
 import argparse
+import os
 import eos
+import eos.constants
+
+
+def _int_at_least(value, minimum):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: '" + value + "'")
+    if number < minimum:
+        raise argparse.ArgumentTypeError("must be at least " + str(minimum) + ", got " + value)
+    return number
+
+
+def _positive_int(value):
+    # argparse type for counts that need to be at least 1
+    return _int_at_least(value, 1)
+
+
+def _non_negative_int(value):
+    # argparse type for sizes that can be 0
+    return _int_at_least(value, 0)
 
 
 def parse():
@@ -31,15 +53,71 @@ def parse():
         action="store_true",
         help="activates snapshot creation of repositories on change; to be used on fallback servers",
     )
+    cl_parser.add_argument(
+        "--snapshot-format",
+        choices=eos.constants.SNAPSHOT_FORMATS,
+        default="gz",
+        help="specifies the compression of snapshots; 'gz' uses pigz, 'xz' and 'zst' use multi-threaded xz or zstd "
+        "where available (default: gz)",
+    )
     cl_parser.add_argument(
         "--fallback-url",
+        action="append",
         help="specifies a fallback URL to use in case a repository or archive cannot be reached "
         "or downloaded; needs to be the URL to another bootstrapping directory to which snapshots "
-        "were written",
+        "were written; can be given multiple times, in which case the mirrors are probed once and "
+        "tried from fastest to slowest",
     )
     cl_parser.add_argument(
         "--force-fallback", action="store_true", help="enforces use of the fallback server under the specified URL"
     )
+    cl_parser.add_argument(
+        "--shared-cache",
+        default=os.environ.get(eos.constants.SHARED_CACHE_ENV_VAR),
+        help="specifies a machine-wide directory in which downloaded files with a known SHA1 hash are shared "
+        "between destination directories; defaults to the value of the "
+        + eos.constants.SHARED_CACHE_ENV_VAR
+        + " environment variable",
+    )
+    cl_parser.add_argument(
+        "--mirror-cache",
+        default=os.environ.get(eos.constants.MIRROR_CACHE_ENV_VAR),
+        help="specifies a machine-wide directory holding one bare mirror per git/hg repository URL, from which "
+        "library checkouts borrow their objects; defaults to the value of the "
+        + eos.constants.MIRROR_CACHE_ENV_VAR
+        + " environment variable",
+    )
+    cl_parser.add_argument(
+        "--paranoid",
+        action="store_true",
+        help="always recompute hashes of already downloaded files, instead of trusting the hash index in the cache",
+    )
+    cl_parser.add_argument(
+        "--download-segments",
+        type=_positive_int,
+        default=1,
+        help="specifies the number of parallel byte ranges that large files are downloaded in, if the server "
+        "supports range requests; can be overridden per library with a 'segments' entry in the source object",
+    )
+    cl_parser.add_argument(
+        "--download-segments-threshold",
+        type=_non_negative_int,
+        default=64,
+        help="specifies the minimum file size in MB for segmented downloads (default: 64)",
+    )
+    cl_parser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        default=1,
+        help="specifies the number of libraries to bootstrap concurrently; output of each library is "
+        "buffered and printed once it is finished",
+    )
+    cl_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="writes timing spans for each library and phase (downloads, extraction, repository commands, "
+        "post-processing) to the given file, in Chrome trace event format (e.g. for Perfetto)",
+    )
     cl_parser.add_argument(
         "-v",
         "--verbose",
@@ -2,3 +2,12 @@ STATE_FILENAME = ".state.json"
 CACHE_DIR_REL = ".cache"
 ARCHIVE_SUBDIR_REL = "archives"
 SNAPSHOT_SUBDIR_REL = "snapshots"
+PRISTINE_SUBDIR_REL = "pristine"
+HASH_INDEX_FILENAME = ".hashes.json"
+SHARED_CACHE_ENV_VAR = "EOS_SHARED_CACHE"
+MIRROR_CACHE_ENV_VAR = "EOS_MIRROR_CACHE"
+REMOTE_CHECK_JOBS = 8
+SNAPSHOT_INDEX_FILENAME = "snapshots.json"
+SNAPSHOT_FORMATS = ["gz", "xz", "zst"]
+SERVE_PORT = 8000
+DOWNLOAD_VALIDATORS_SUFFIX = ".validators.json"
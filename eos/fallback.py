@@ -1,19 +1,136 @@
+import concurrent.futures
+import http.client
+import json
 import os
 import shutil
+import threading
+import time
 import urllib.request
 
 import eos.archive
 import eos.cache
 import eos.constants
+import eos.net
 import eos.util
 
+# snapshot indices read from fallback servers, per fallback URL
+_SNAPSHOT_INDICES = {}
+_SNAPSHOT_INDICES_LOCK = threading.Lock()
+
+PROBE_TIMEOUT = 5  # seconds
+
+# probed fallback URLs, mapped to their latency in seconds, or None if unreachable
+_FALLBACK_LATENCIES = {}
+_FALLBACK_LATENCIES_LOCK = threading.Lock()
+
+
+def _probe_fallback_url(url):
+    # returns the latency of a HEAD request to the fallback URL, or None if the server is unreachable or failing
+    start = time.perf_counter()
+    try:
+        with eos.net.request(url, method="HEAD", timeout=PROBE_TIMEOUT) as response:
+            if response.status >= 500:
+                return None
+    except (IOError, http.client.HTTPException):
+        return None
+    return time.perf_counter() - start
+
+
+def _probe_and_record(url):
+    latency = _probe_fallback_url(url)
+    with _FALLBACK_LATENCIES_LOCK:
+        _FALLBACK_LATENCIES[url] = latency
+    if latency is None:
+        eos.log_warning("fallback URL " + url + " is not reachable")
+    else:
+        eos.log_verbose("Fallback URL " + url + " responded in " + str(round(latency * 1000.0, 1)) + " ms")
+    return latency
+
+
+def probe_fallback_urls(fallback_urls):
+    # Probes all HTTP(S) fallback URLs concurrently, once; the results determine the order in which they are tried.
+    urls = [url for url in fallback_urls if eos.net.is_http_url(url)]
+    if not urls:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        list(executor.map(_probe_and_record, urls))
+
+
+def rank_fallback_urls(fallback_urls):
+    # reachable URLs by latency first, then URLs that were not probed (e.g. file:// URLs) in the given order, then
+    # unreachable URLs as a last resort
+    def rank(url):
+        with _FALLBACK_LATENCIES_LOCK:
+            if url not in _FALLBACK_LATENCIES:
+                return 1, 0.0
+            latency = _FALLBACK_LATENCIES[url]
+        return (0, latency) if latency is not None else (2, 0.0)
+
+    return sorted(fallback_urls, key=rank)
+
+
+def _get_fallback_download_url(fallback_url, relative_src_dir, filename):
+    p = urllib.request.urlparse(fallback_url)
+    new_path = p[2] + "/" + relative_src_dir + "/" + filename
+    return urllib.request.urlunparse([p[0], p[1], new_path, p[3], p[4], p[5]])
+
+
+def _read_url(url):
+    if not eos.net.is_http_url(url):
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+    with eos.net.request(url) as response:
+        data = response.read()
+        if response.status != 200:
+            raise IOError("HTTP error " + str(response.status) + " (" + response.reason + ")")
+        return data
+
+
+def _read_snapshot_index(fallback_url):
+    relative_snapshot_dir = eos.util.convert_to_forward_slashes(eos.cache.get_relative_snapshot_dir())
+    url = _get_fallback_download_url(fallback_url, relative_snapshot_dir, eos.constants.SNAPSHOT_INDEX_FILENAME)
+    try:
+        index = json.loads(_read_url(url).decode("utf-8"))
+    except (IOError, ValueError, http.client.HTTPException) as e:
+        eos.log_verbose("Reading snapshot index " + url + " failed (" + str(e) + "); assuming .tar.gz snapshots")
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def get_snapshot_filename(fallback_url, snapshot_name):
+    # Returns the filename of the snapshot archive with the given name, as recorded in the snapshot index of the
+    # fallback server. Servers without index (i.e. of older versions) only have .tar.gz snapshots.
+    if fallback_url is None:
+        return snapshot_name + ".tar.gz"
+    with _SNAPSHOT_INDICES_LOCK:
+        if fallback_url not in _SNAPSHOT_INDICES:
+            _SNAPSHOT_INDICES[fallback_url] = _read_snapshot_index(fallback_url)
+        index = _SNAPSHOT_INDICES[fallback_url]
+    return index.get(snapshot_name, snapshot_name + ".tar.gz")
+
+
+def download_from_fallback_urls(
+    fallback_urls, filename, relative_src_dir, download_dir, extract_dir, sha1_hash_expected=None
+):
+    # Tries the fallback URLs from fastest to slowest, until one succeeds. The filename can also be a function of the
+    # fallback URL, e.g. for snapshots, whose format may differ between servers.
+    for fallback_url in rank_fallback_urls(fallback_urls):
+        fallback_filename = filename(fallback_url) if callable(filename) else filename
+        eos.log("Downloading from fallback URL " + fallback_url)
+        if download_from_fallback_url(
+            fallback_url, fallback_filename, relative_src_dir, download_dir, extract_dir, sha1_hash_expected
+        ):
+            return True
+        # demote the server for all following downloads, if it became unreachable
+        if eos.net.is_http_url(fallback_url):
+            _probe_and_record(fallback_url)
+    return False
+
 
 def download_from_fallback_url(
     fallback_url, filename, relative_src_dir, download_dir, extract_dir, sha1_hash_expected=None
 ):
-    p = urllib.request.urlparse(fallback_url)
-    new_path = p[2] + "/" + relative_src_dir + "/" + filename
-    fallback_download_url = urllib.request.urlunparse([p[0], p[1], new_path, p[3], p[4], p[5]])
+    fallback_download_url = _get_fallback_download_url(fallback_url, relative_src_dir, filename)
 
     download_filename = eos.util.download_file(
         fallback_download_url, download_dir, sha1_hash_expected=sha1_hash_expected
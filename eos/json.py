@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import json
+import os
 
 from eos.log import log_error
 
@@ -23,10 +24,30 @@ def write_file(filename, data):
         json.dump(data, file)
 
 
+def write_file_atomic(filename, data):
+    # write to a temporary file first and rename it, such that an interrupted write never leaves a corrupt file
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
 def get_library_names(data):
     return [name for name in (obj.get("name", None) for obj in data) if name]
 
 
+def get_library_index(data):
+    # maps library names to library objects; the first object wins for duplicate names
+    index = {}
+    for obj in data:
+        name = obj.get("name", None)
+        if name and name not in index:
+            index[name] = obj
+    return index
+
+
 def get_library_object(data, name):
     for obj in data:
         if obj.get("name", None) == name:
@@ -40,3 +61,27 @@ def has_branch_follow_property(obj):
         if src.get("branch-follow", None):
             return True
     return False
+
+
+def has_unhashed_download(obj):
+    # files and archives without SHA1 hash may change upstream while their JSON object stays the same
+    src = obj.get("source", None) or {}
+    return src.get("type", None) in ["file", "archive"] and not src.get("sha1", None)
+
+
+def has_valid_download_segments(obj):
+    # the optional 'segments' of a source is the number of byte ranges to download it in; a positive integer
+    segments = obj.get("source", {}).get("segments", None)
+    if segments is None or (isinstance(segments, int) and not isinstance(segments, bool) and segments > 0):
+        return True
+    log_error("'segments' of library '" + str(obj.get("name", None)) + "' is not a positive integer")
+    return False
+
+
+def get_library_dependencies(obj):
+    # returns the names of the libraries the library depends on, or None if 'depends' is not a list of names
+    dependencies = obj.get("depends", [])
+    if not isinstance(dependencies, list) or not all(isinstance(dependency, str) for dependency in dependencies):
+        log_error("'depends' of library '" + str(obj.get("name", None)) + "' is not a list of library names")
+        return None
+    return dependencies
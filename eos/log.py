@@ -1,7 +1,13 @@
 from __future__ import print_function
 
+import sys
+import threading
+
 VERBOSITY = 0
 
+_BUFFER = threading.local()
+_OUTPUT_LOCK = threading.Lock()
+
 
 def set_verbosity(verbosity):
     global VERBOSITY
@@ -13,19 +19,53 @@ def verbosity():
     return VERBOSITY
 
 
+def begin_log_buffering():
+    # collect all messages logged from the current thread instead of printing them
+    _BUFFER.messages = []
+
+
+def end_log_buffering():
+    # stop buffering for the current thread and return everything collected so far
+    messages = getattr(_BUFFER, "messages", None)
+    _BUFFER.messages = None
+    return messages if messages else []
+
+
+def is_log_buffering():
+    return getattr(_BUFFER, "messages", None) is not None
+
+
+def log_output(output):
+    # raw output (e.g. of an executed command), without trailing newline handling
+    if is_log_buffering():
+        _BUFFER.messages.append(output.rstrip("\n"))
+        return
+    with _OUTPUT_LOCK:
+        sys.stdout.write(output)
+        sys.stdout.flush()
+
+
+def _print(message):
+    if is_log_buffering():
+        _BUFFER.messages.append(message)
+        return
+    with _OUTPUT_LOCK:
+        print(message)
+
+
 def log(message):
-    print(message)
+    _print(message)
 
 
 def log_verbose(message, level=1):
     global VERBOSITY
     if VERBOSITY >= level:
-        print("--- " + message)
+        _print("--- " + message)
 
 
 def log_warning(message):
-    print("--- WARNING: " + message)
+    _print("--- WARNING: " + message)
 
 
 def log_error(message):
-    print("--- ERROR: " + message)
+    _print("--- ERROR: " + message)
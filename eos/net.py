@@ -0,0 +1,143 @@
+import base64
+import contextlib
+import http.client
+import threading
+import urllib.parse
+import urllib.request
+
+import eos.log
+
+TIMEOUT = 60  # seconds
+MAX_REDIRECTS = 10
+REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]
+
+# idle keep-alive connections, per (scheme, host, port, proxy); shared across all downloads of a run
+_CONNECTION_POOL = {}
+_CONNECTION_POOL_LOCK = threading.Lock()
+
+
+def is_http_url(url):
+    return urllib.parse.urlparse(url).scheme in ["http", "https"]
+
+
+def _get_proxy(scheme, host):
+    if urllib.request.proxy_bypass(host):
+        return None
+    return urllib.request.getproxies().get(scheme, None)
+
+
+def _get_connection_key(url):
+    p = urllib.parse.urlparse(url)
+    port = p.port or (443 if p.scheme == "https" else 80)
+    return p.scheme, p.hostname, port, _get_proxy(p.scheme, p.hostname)
+
+
+def _create_connection(key):
+    scheme, host, port, proxy = key
+    if not proxy:
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=TIMEOUT)
+        return http.client.HTTPConnection(host, port, timeout=TIMEOUT)
+
+    pp = urllib.parse.urlparse(proxy if "://" in proxy else "http://" + proxy)
+    proxy_headers = {}
+    if pp.username:
+        credentials = urllib.parse.unquote(pp.username) + ":" + urllib.parse.unquote(pp.password or "")
+        proxy_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+
+    if scheme == "https":
+        # tunnel through the proxy via CONNECT
+        connection = http.client.HTTPSConnection(pp.hostname, pp.port or 8080, timeout=TIMEOUT)
+        connection.set_tunnel(host, port, headers=proxy_headers)
+    else:
+        connection = http.client.HTTPConnection(pp.hostname, pp.port or 8080, timeout=TIMEOUT)
+    connection.proxy_headers = proxy_headers
+    return connection
+
+
+def _acquire_connection(key):
+    with _CONNECTION_POOL_LOCK:
+        connections = _CONNECTION_POOL.get(key, None)
+        if connections:
+            return connections.pop(), True
+    return _create_connection(key), False
+
+
+def _release_connection(key, connection, response):
+    # responses without body (e.g. HEAD, 304) need to be read to free the connection
+    if not response.isclosed() and response.length == 0:
+        response.read()
+
+    if response.isclosed() and not response.will_close:
+        with _CONNECTION_POOL_LOCK:
+            _CONNECTION_POOL.setdefault(key, []).append(connection)
+    else:
+        connection.close()
+
+
+def _send_request(connection, key, method, url, headers):
+    scheme, host, port, proxy = key
+    p = urllib.parse.urlparse(url)
+    if proxy and scheme == "http":
+        target = url  # plain HTTP proxies expect the absolute URL
+        headers = dict(headers, **connection.proxy_headers)
+    else:
+        target = urllib.parse.urlunparse(["", "", p.path or "/", p.params, p.query, ""])
+    connection.request(method, target, headers=headers)
+    return connection.getresponse()
+
+
+def _set_timeout(connection, timeout):
+    # pooled connections may have been used with another timeout before
+    connection.timeout = timeout
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+
+
+def _request_once(method, url, headers, timeout):
+    key = _get_connection_key(url)
+    connection, reused = _acquire_connection(key)
+    _set_timeout(connection, timeout)
+    try:
+        return key, connection, _send_request(connection, key, method, url, headers)
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        if not reused:
+            raise
+
+    # the server may have closed an idle keep-alive connection; retry once on a fresh one
+    connection = _create_connection(key)
+    _set_timeout(connection, timeout)
+    try:
+        return key, connection, _send_request(connection, key, method, url, headers)
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        raise
+
+
+@contextlib.contextmanager
+def request(url, headers=None, method="GET", timeout=TIMEOUT):
+    # Context manager yielding the http.client.HTTPResponse for the given URL, following redirects. The connection
+    # is returned to the pool on exit if the response was read completely, and closed otherwise.
+    headers = dict(headers) if headers else {}
+
+    for _ in range(MAX_REDIRECTS + 1):
+        key, connection, response = _request_once(method, url, headers, timeout)
+
+        location = response.getheader("Location", None)
+        if response.status in REDIRECT_STATUS_CODES and location:
+            response.read()
+            _release_connection(key, connection, response)
+            eos.log_verbose("Redirected from " + url + " to " + location, level=2)
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303:
+                method = "GET"
+            continue
+
+        try:
+            yield response
+        finally:
+            _release_connection(key, connection, response)
+        return
+
+    raise IOError("too many redirects for " + url)
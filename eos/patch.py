@@ -0,0 +1,297 @@
+import datetime
+import os
+import re
+import shutil
+import threading
+
+import eos.log
+
+# Applies unified diffs in-process: the patch file is parsed once, all hunks are located in memory, and only then are
+# the changed files written (each one atomically). Like 'patch', hunks are found at an offset if lines were added or
+# removed elsewhere, but no fuzz is applied. Anything else (context diffs, git binary patches, renames, mode changes,
+# hunks that do not apply exactly) is left to the 'patch' command, which also reports the errors.
+
+_HUNK_HEADER = re.compile(rb"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+_TIMESTAMP = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:\.\d+)? ([+-]\d{4})$")
+_DEV_NULL = b"/dev/null"
+
+# lines outside of hunks that mark something only 'patch' (or nothing) handles
+_UNSUPPORTED_PREFIXES = (
+    b"*** ",
+    b"GIT binary patch",
+    b"Binary files ",
+    b"old mode ",
+    b"new mode ",
+    b"rename from ",
+    b"copy from ",
+)
+
+
+class _UnsupportedPatch(Exception):
+    pass
+
+
+def _split_lines(data):
+    # splits after each '\n' only, like 'patch'; a '\r' is part of the line
+    lines = [line + b"\n" for line in data.split(b"\n")]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
+
+
+def _parse_filename(line):
+    # returns the filename and the timestamp of a '---' or '+++' line
+    name, _, timestamp = line[4:].rstrip(b"\r\n").partition(b"\t")
+    if name.startswith(b'"'):
+        raise _UnsupportedPatch("quoted filename")
+    return name, timestamp.decode("utf-8", errors="replace").strip()
+
+
+def _is_epoch(timestamp):
+    # 'diff -N' marks missing files with the epoch as timestamp (in local time)
+    match = _TIMESTAMP.match(timestamp)
+    if not match:
+        return None
+    return datetime.datetime.strptime(" ".join(match.groups()), "%Y-%m-%d %H:%M:%S %z").timestamp() == 0
+
+
+def _parse_hunk(lines, index, header):
+    # returns the hunk (old start, old lines, new lines, number of leading and trailing context lines) and the index of
+    # the line after it
+    match = _HUNK_HEADER.match(header)
+    if not match:
+        raise _UnsupportedPatch("malformed hunk header")
+    old_start, old_count, new_start, new_count = match.groups()
+    old_remaining = 1 if old_count is None else int(old_count)
+    new_remaining = 1 if new_count is None else int(new_count)
+    old_lines = []
+    new_lines = []
+    last_sides = []
+    tags = b""
+
+    while old_remaining > 0 or new_remaining > 0 or (index < len(lines) and lines[index].startswith(b"\\")):
+        if index >= len(lines):
+            raise _UnsupportedPatch("truncated hunk")
+        line = lines[index]
+        index += 1
+        tag = line[:1]
+        if tag == b"\\":
+            # '\ No newline at end of file' applies to the previous line
+            for side in last_sides:
+                side[-1] = side[-1][:-1] if side[-1].endswith(b"\n") else side[-1]
+            continue
+        if line in [b"\n", b"\r\n"]:
+            tag, line = b" ", b" " + line  # empty context line, with its trailing whitespace stripped
+        if tag == b" ":
+            last_sides = [old_lines, new_lines]
+            old_remaining -= 1
+            new_remaining -= 1
+        elif tag == b"-":
+            last_sides = [old_lines]
+            old_remaining -= 1
+        elif tag == b"+":
+            last_sides = [new_lines]
+            new_remaining -= 1
+        else:
+            raise _UnsupportedPatch("unexpected line in hunk")
+        tags += tag
+        if old_remaining < 0 or new_remaining < 0:
+            raise _UnsupportedPatch("hunk line counts do not match its header")
+        for side in last_sides:
+            side.append(line[1:])
+
+    # a hunk that adds lines only gives the line after which they go
+    position = max(int(old_start) - (1 if old_lines else 0), 0)
+    prefix_context = len(tags) - len(tags.lstrip(b" "))
+    suffix_context = len(tags) - len(tags.rstrip(b" "))
+    return (position, old_lines, new_lines, prefix_context, suffix_context), index
+
+
+def _parse_patch(data):
+    # returns a list of file patches (old name, old timestamp, new name, new timestamp, hunks)
+    lines = _split_lines(data)
+    file_patches = []
+    index = 0
+    in_git_header = False
+    while index < len(lines):
+        line = lines[index]
+        index += 1
+        if line.startswith(b"diff --git "):
+            if in_git_header:
+                raise _UnsupportedPatch("git diff without hunks")  # e.g. an empty new file
+            in_git_header = True
+        if line.startswith(_UNSUPPORTED_PREFIXES) or (
+            line.startswith((b"new file mode ", b"deleted file mode ")) and not line.rstrip().endswith(b"100644")
+        ):
+            raise _UnsupportedPatch("unsupported patch format: " + line.rstrip().decode("utf-8", errors="replace"))
+        if not line.startswith(b"--- ") or index >= len(lines) or not lines[index].startswith(b"+++ "):
+            continue  # 'diff' command lines, 'Index:' lines, comments
+
+        in_git_header = False
+        old_name, old_timestamp = _parse_filename(line)
+        new_name, new_timestamp = _parse_filename(lines[index])
+        index += 1
+        hunks = []
+        while index < len(lines) and lines[index].startswith(b"@@ "):
+            hunk, index = _parse_hunk(lines, index + 1, lines[index])
+            hunks.append(hunk)
+        if not hunks:
+            raise _UnsupportedPatch("file without hunks")
+        file_patches.append((old_name, old_timestamp, new_name, new_timestamp, hunks))
+
+    if in_git_header:
+        raise _UnsupportedPatch("git diff without hunks")
+    if not file_patches:
+        raise _UnsupportedPatch("no unified diff found")
+    return file_patches
+
+
+def _strip_path(name, pnum):
+    # strips the first pnum components, like 'patch -p<pnum>'; runs of slashes count as one separator
+    match = re.match(rb"(?:[^/]*/+){" + str(pnum).encode() + rb"}", name)
+    if not match:
+        raise _UnsupportedPatch("filename with fewer than " + str(pnum) + " components")
+    path = name[match.end() :]
+    if not path or path.startswith(b"/") or b".." in path.split(b"/"):
+        raise _UnsupportedPatch("filename outside of the library directory")
+    return os.fsdecode(path)
+
+
+def _get_candidate_positions(position, min_position, max_position):
+    # like 'patch', the expected position first, then increasing offsets, the later lines first
+    yield position
+    for offset in range(1, max(position - min_position, max_position - position) + 1):
+        yield position + offset
+        yield position - offset
+
+
+def _find_hunk(lines, hunk, position, min_position):
+    # Locates the hunk like 'patch' does without fuzz. A hunk with less leading context than trailing context
+    # (or vice versa) was cut off by the start (end) of the file, so it can only match there.
+    start, old_lines, _, prefix_context, suffix_context = hunk
+    if not old_lines:
+        return position if min_position <= position <= len(lines) else None
+
+    max_position = len(lines) - len(old_lines)
+    context = max(prefix_context, suffix_context)
+    if prefix_context < context and start == 0:
+        candidates = [0] if suffix_context == context or max_position == 0 else []
+    elif suffix_context < context:
+        candidates = [max_position]
+    else:
+        candidates = _get_candidate_positions(position, min_position, max_position)
+    for candidate in candidates:
+        if min_position <= candidate <= max_position and lines[candidate : candidate + len(old_lines)] == old_lines:
+            return candidate
+    return None
+
+
+def _apply_hunks(lines, hunks):
+    result = []
+    last = 0
+    offset = 0
+    for hunk in hunks:
+        position, old_lines, new_lines = hunk[:3]
+        found = _find_hunk(lines, hunk, position + offset, last)
+        if found is None:
+            raise _UnsupportedPatch("hunk does not apply at line " + str(position + 1))
+        offset = found - position
+        result += lines[last:found]
+        result += new_lines
+        last = found + len(old_lines)
+    result += lines[last:]
+    # like 'patch', a line without newline that does not end up at the end of the file gets one
+    for index in range(len(result) - 1):
+        if not result[index].endswith(b"\n"):
+            result[index] += b"\n"
+    return result
+
+
+def _read_lines(filename):
+    with open(filename, "rb") as f:
+        return _split_lines(f.read())
+
+
+def _compute_patched_files(library_dir, file_patches, pnum):
+    # returns the new contents of the patched files (as lists of lines), or None for files to delete
+    patched_files = {}
+    for old_name, old_timestamp, new_name, new_timestamp, hunks in file_patches:
+        is_creation = old_name == _DEV_NULL
+        is_deletion = new_name == _DEV_NULL
+        path = _strip_path(new_name if is_creation else old_name, pnum)
+        if not is_creation and not is_deletion and _strip_path(new_name, pnum) != path:
+            raise _UnsupportedPatch("renamed file")
+        filename = os.path.join(library_dir, path)
+
+        if filename in patched_files:
+            lines = patched_files[filename]
+            if lines is None:
+                raise _UnsupportedPatch("file patched after deletion")
+        elif os.path.isfile(filename):
+            lines = _read_lines(filename)
+        elif os.path.exists(filename) or not (is_creation or (len(hunks) == 1 and hunks[0][:2] == (0, []))):
+            raise _UnsupportedPatch("missing file " + path)
+        else:
+            lines = []  # a new file
+        if lines and (is_creation or _is_epoch(old_timestamp)):
+            raise _UnsupportedPatch("file to be created exists already: " + path)
+
+        lines = _apply_hunks(lines, hunks)
+        if not is_deletion:
+            # 'diff -N' marks deleted files with the epoch as timestamp; without, an emptied file is kept
+            is_deletion = _is_epoch(new_timestamp)
+            if is_deletion is None and not lines:
+                raise _UnsupportedPatch("emptied file with unknown timestamp format")
+        if is_deletion and lines:
+            raise _UnsupportedPatch("file to be deleted is not empty after patching: " + path)
+        patched_files[filename] = None if is_deletion else lines
+    return patched_files
+
+
+def _write_file(filename, lines):
+    # writes to a temporary file next to the destination first, such that the destination is replaced atomically
+    tmp_filename = filename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.writelines(lines)
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def _remove_file(library_dir, filename):
+    os.remove(filename)
+    # like 'patch', remove directories that became empty
+    directory = os.path.dirname(filename)
+    while os.path.abspath(directory) != os.path.abspath(library_dir):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def apply_patch_file(library_dir, patch_file, pnum):
+    # Applies the patch file to the library directory; returns False if the patch has to be applied with the 'patch'
+    # command instead, in which case nothing was changed. Raises IOError if writing the patched files fails.
+    try:
+        with open(patch_file, "rb") as f:
+            file_patches = _parse_patch(f.read())
+        patched_files = _compute_patched_files(library_dir, file_patches, pnum)
+    except _UnsupportedPatch as e:
+        eos.log_verbose("Patch file " + patch_file + " is applied with 'patch' (" + str(e) + ")", level=2)
+        return False
+
+    for filename, lines in patched_files.items():
+        if lines is None:
+            if os.path.exists(filename):
+                _remove_file(library_dir, filename)
+        else:
+            _write_file(filename, lines)
+    return True
@@ -1,38 +1,65 @@
+import hashlib
+import json
 import os
 
 import eos.log
+import eos.patch
 import eos.tools
 import eos.util
 
 
+def get_step_fingerprint(post, post_file, source_revision):
+    # Fingerprint of a post-processing step: its JSON object, the contents of its patch file or script (the first word
+    # of the script command), and the revision of the source it is applied to.
+    fingerprint = hashlib.sha1()
+    fingerprint.update(json.dumps(post, sort_keys=True).encode("utf-8") + b"\0")
+    fingerprint.update((source_revision or "").encode("utf-8") + b"\0")
+    step_file = post_file.split(" ")[0] if post_file and post.get("type", None) == "script" else post_file
+    if step_file and os.path.isfile(step_file):
+        with open(step_file, "rb") as f:
+            fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
 def apply_patch(library_name, library_dir, patch_file, pnum):
     # We're assuming the patch was applied like in this example:
     # diff --exclude=".git" --exclude=".hg" -rupN ./LIBNAME ./LIBNAME_patched > libname.patch
     # where the first given location is the unpatched directory, and the second location is the patched directory.
     eos.log_verbose("Applying patch file " + patch_file + " to library '" + library_name + "'...")
 
-    arguments = "-d " + library_dir + " -p" + str(pnum) + " < " + patch_file
-    arguments_binary = "-d " + library_dir + " -p" + str(pnum) + " --binary < " + patch_file
+    # most patches are applied in-process; the 'patch' command handles the rest, and reports failures
+    try:
+        if eos.patch.apply_patch_file(library_dir, patch_file, pnum):
+            return True
+    except (IOError, OSError) as e:
+        eos.log_error("applying patch file " + patch_file + " failed: " + str(e))
+        return False
+
+    arguments = ["-d", library_dir, "-p" + str(pnum)]
+    arguments_binary = arguments + ["--binary"]
 
     print_cmd = eos.verbosity() > 1
 
-    status = eos.util.execute_command(
-        eos.tools.command_patch() + " --dry-run " + arguments, print_command=print_cmd, quiet=True
-    )
+    def execute_patch(options, print_command=print_cmd, quiet=True):
+        # the patch file is given on stdin
+        with open(patch_file, "rb") as f:
+            return eos.util.execute_command(
+                [eos.tools.command_patch()] + options, print_command=print_command, quiet=quiet, stdin=f
+            )
+
+    status = execute_patch(["--dry-run"] + arguments)
 
     if status != 0:
         # try again in binary mode
         arguments = arguments_binary
-        status = eos.util.execute_command(
-            eos.tools.command_patch() + " --dry-run " + arguments, print_command=print_cmd, quiet=True
-        )
+        status = execute_patch(["--dry-run"] + arguments)
 
     if status != 0:
         eos.log_error("patch application failure; has this patch already been applied?")
-        eos.util.execute_command(eos.tools.command_patch() + " --dry-run " + arguments, print_command=True)
+        execute_patch(["--dry-run"] + arguments, print_command=True, quiet=False)
         return False
 
-    status = eos.util.execute_command(eos.tools.command_patch() + " " + arguments, print_command=print_cmd, quiet=True)
+    status = execute_patch(arguments)
     return status == 0
 
 
@@ -0,0 +1,165 @@
+import concurrent.futures
+import errno
+import os
+import shutil
+import stat
+import sys
+
+try:
+    import fcntl
+
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+import eos.archive
+import eos.cache
+import eos.log
+import eos.trace
+import eos.util
+
+# Keeps one pristine (unmodified) tree per archive, keyed by its SHA1 hash, in '.cache/pristine/<library>/<hash>'.
+# Library directories are materialized from it instead of extracting the archive again: with reflinks (FICLONE) where
+# the file system supports them, with in-kernel copies (copy_file_range) otherwise, and with plain copies as last
+# resort. Files are never hard-linked, since post-processing may modify them in place, which would alter the tree.
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), from linux/fs.h
+MATERIALIZE_JOBS = min(32, os.cpu_count() or 1)
+COPY_FILE_RANGE_SIZE = 1 << 30
+
+# errors that mean that the file system (or the kernel) does not support the method
+_UNSUPPORTED_ERRNOS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EPERM]
+
+# turned off after the first unsupported error, such that it is not tried again for each file
+_use_ficlone = FCNTL_AVAILABLE and sys.platform.startswith("linux")
+_use_copy_file_range = hasattr(os, "copy_file_range")
+
+
+def _clone_file_contents(src, dst):
+    global _use_ficlone
+    global _use_copy_file_range
+
+    if _use_ficlone:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _use_ficlone = False
+            eos.log_verbose("Reflinks are not supported; falling back to copying", level=2)
+
+    if _use_copy_file_range:
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), COPY_FILE_RANGE_SIZE) > 0:
+                pass
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _use_copy_file_range = False
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+
+    shutil.copyfileobj(src, dst, eos.util.BUFFER_SIZE)
+
+
+def clone_file(src_filename, dst_filename):
+    # copies the file, sharing its data blocks with the source where the file system supports it
+    with open(src_filename, "rb") as src, open(dst_filename, "wb") as dst:
+        _clone_file_contents(src, dst)
+
+
+def _copy_file(src_filename, dst_filename, st):
+    clone_file(src_filename, dst_filename)
+    os.chmod(dst_filename, stat.S_IMODE(st.st_mode))
+    os.utime(dst_filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _create_tree(src_dir, dst_dir, directories, files):
+    # creates the directories and symbolic links, and collects the files to copy
+    os.mkdir(dst_dir)
+    directories.append((dst_dir, os.stat(src_dir)))
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            dst_path = os.path.join(dst_dir, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dst_path)
+                if os.utime in os.supports_follow_symlinks:
+                    st = entry.stat(follow_symlinks=False)
+                    os.utime(dst_path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+            elif entry.is_dir():
+                _create_tree(entry.path, dst_path, directories, files)
+            else:
+                files.append((entry.path, dst_path, entry.stat()))
+
+
+def materialize_tree(src_dir, dst_dir):
+    # Recreates the tree in dst_dir (which must not exist), keeping modes and modification times, such that build
+    # systems see the same tree as after extracting the archive.
+    assert not os.path.exists(dst_dir)
+    with eos.trace.span(os.path.basename(dst_dir), "materialize") as trace_args:
+        directories = []
+        files = []
+        _create_tree(src_dir, dst_dir, directories, files)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MATERIALIZE_JOBS) as executor:
+            for future in [executor.submit(_copy_file, *file) for file in files]:
+                future.result()
+        # deepest directories first, since creating their contents changed the modification times of their parents
+        for directory, st in reversed(directories):
+            os.chmod(directory, stat.S_IMODE(st.st_mode))
+            os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns))
+        trace_args["files"] = len(files)
+        trace_args["method"] = "reflink" if _use_ficlone else "copy_file_range" if _use_copy_file_range else "copy"
+
+
+def _get_archive_hash(filename):
+    sha1_hash = eos.cache.get_verified_hash(filename)
+    if not sha1_hash:
+        sha1_hash = eos.util.compute_sha1_hash(filename)
+        eos.cache.set_verified_hash(filename, sha1_hash)
+    return sha1_hash
+
+
+def _get_pristine_tree(archive_filename, name):
+    # returns the pristine tree of the archive, extracting it first if needed; None if the extraction failed
+    sha1_hash = _get_archive_hash(archive_filename)
+    library_pristine_dir = eos.cache.get_pristine_dir(name)
+    pristine_dir = os.path.join(library_pristine_dir, sha1_hash)
+    if os.path.isdir(pristine_dir):
+        eos.log_verbose("Using pristine tree of " + archive_filename, level=2)
+        return pristine_dir
+
+    partial_dir = pristine_dir + "." + str(os.getpid()) + ".part"
+    if os.path.exists(partial_dir):
+        shutil.rmtree(partial_dir)
+    if not os.path.isdir(library_pristine_dir):
+        os.makedirs(library_pristine_dir)
+    if not eos.archive.extract_file(archive_filename, partial_dir):
+        if os.path.exists(partial_dir):
+            shutil.rmtree(partial_dir)
+        return None
+    os.rename(partial_dir, pristine_dir)
+
+    # trees of earlier versions of the archive are not needed anymore
+    for entry in os.listdir(library_pristine_dir):
+        if entry != sha1_hash:
+            shutil.rmtree(os.path.join(library_pristine_dir, entry), ignore_errors=True)
+    return pristine_dir
+
+
+def extract_archive(archive_filename, name, library_dir):
+    # Like eos.archive.extract_file(), but materializes library_dir from the pristine tree of the archive. Falls back to
+    # extracting the archive directly if the pristine tree cannot be used, e.g. on a full disk.
+    try:
+        pristine_dir = _get_pristine_tree(archive_filename, name)
+        if pristine_dir is None:
+            return False
+        materialize_tree(pristine_dir, library_dir)
+        return True
+    except (IOError, OSError) as e:
+        eos.log_warning("materializing library '" + name + "' from its pristine tree failed: " + str(e))
+    if os.path.exists(library_dir):
+        shutil.rmtree(library_dir)
+    return eos.archive.extract_file(archive_filename, library_dir)
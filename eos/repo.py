@@ -1,9 +1,27 @@
+import hashlib
 import os
 import shutil
+import threading
+
+try:
+    import fcntl
+
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+import eos.cache
 import eos.log
+import eos.session
 import eos.tools
+import eos.trace
 import eos.util
 
+# mirrors that were already refreshed in this run, and one lock per mirror directory
+_MIRRORS_REFRESHED = set()
+_MIRROR_LOCKS = {}
+_MIRROR_LOCKS_LOCK = threading.Lock()
+
 
 def _check_return_code(code):
     if code != 0:
@@ -11,19 +29,58 @@ def _check_return_code(code):
 
 
 def _remove_directory(directory):
+    eos.session.close_git_session(directory)
     if os.path.exists(directory):
         shutil.rmtree(directory)
 
 
-def _execute(command):
+def _run_hg_command(args, print_command):
+    # hg commands go through a long-running command server, saving the interpreter start for each of them
+    if not args or args[0] != eos.tools.command_hg():
+        return None
+    if print_command:
+        eos.log("> " + eos.util.format_command(args))
+    return eos.session.run_hg_command(args[1:])
+
+
+def _get_command_name(args):
+    # e.g. 'git fetch' for ['/usr/bin/git', '-C', 'dir', 'fetch', '--depth', '1']
+    name = os.path.basename(args[0])
+    options_with_value = ["-C", "-R", "--config"]
+    for previous, arg in zip(args, args[1:]):
+        if not arg.startswith("-") and previous not in options_with_value:
+            return name + " " + arg
+    return name
+
+
+def _execute(args):
     print_command = eos.verbosity() > 1
     quiet = eos.verbosity() <= 2
-    return eos.util.execute_command(command, print_command, quiet)
+    with eos.trace.span(_get_command_name(args), "repo", command=eos.util.format_command(args)):
+        result = _run_hg_command(args, print_command)
+        if result is None:
+            return eos.util.execute_command(args, print_command, quiet)
+    rcode, out, err = result
+    if not quiet and (out or err):
+        eos.log_output(out + err)
+    return rcode
 
 
-def _execute_and_capture_output(command):
+def _execute_and_capture_output(args):
     print_command = eos.verbosity() > 1
-    return eos.util.execute_command_capture_output(command, print_command)
+    with eos.trace.span(_get_command_name(args), "repo", command=eos.util.format_command(args)):
+        result = _run_hg_command(args, print_command)
+        if result is None:
+            return eos.util.execute_command_capture_output(args, print_command)
+    return result
+
+
+def _git(directory, *args):
+    return [eos.tools.command_git(), "-C", directory] + list(args)
+
+
+def _hg(directory, *args):
+    return [eos.tools.command_hg(), "-R", directory] + list(args)
 
 
 # -----
@@ -37,34 +94,40 @@ def hg_repo_exists(directory):
 def git_repo_exists(directory):
     return (
         os.path.exists(os.path.join(directory, ".git"))
-        and _execute_and_capture_output(eos.tools.command_git() + " -C " + directory + " rev-parse --git-dir")[0] == 0
+        and _execute_and_capture_output(_git(directory, "rev-parse", "--git-dir"))[0] == 0
     )
 
 
 def hg_clone(url, directory):
-    return _execute(eos.tools.command_hg() + " clone " + url + " " + directory)
+    return _execute([eos.tools.command_hg(), "clone", url, directory])
+
+
+def hg_share(source, directory):
+    return _execute([eos.tools.command_hg(), "share", "-U", "--config", "extensions.share=", source, directory])
 
 
 def hg_pull(directory):
-    return _execute(eos.tools.command_hg() + " pull -R " + directory)
+    return _execute(_hg(directory, "pull"))
 
 
 def hg_purge(directory):
-    return _execute(eos.tools.command_hg() + " purge -R " + directory + " --all --config extensions.purge=")
+    return _execute(_hg(directory, "purge", "--all", "--config", "extensions.purge="))
 
 
 def hg_update_to_revision(directory, revision=None):
-    if revision is None:
-        revision = ""
-    return _execute(eos.tools.command_hg() + " update -R " + directory + " -C " + revision)
+    return _execute(_hg(directory, "update", "-C", *([revision] if revision else [])))
 
 
 def hg_update_to_branch_tip(directory, branch):
-    return _execute(eos.tools.command_hg() + " update -R " + directory + " -C " + branch)
+    return _execute(_hg(directory, "update", "-C", branch))
+
+
+def hg_has_revision(directory, revision):
+    return _execute(_hg(directory, "log", "-q", "-r", revision)) == 0
 
 
 def hg_verify_commit_hash(directory, expected_commit_hash):
-    rcode, out, err = _execute_and_capture_output(eos.tools.command_hg() + " -R " + directory + " --debug id -i")
+    rcode, out, err = _execute_and_capture_output(_hg(directory, "--debug", "id", "-i"))
     if rcode != 0:
         return False
     current_commit_hash = out
@@ -72,82 +135,293 @@ def hg_verify_commit_hash(directory, expected_commit_hash):
     return hash_match
 
 
+def hg_get_working_state(directory):
+    rcode, out, err = _execute_and_capture_output(_hg(directory, "--debug", "id", "-i"))
+    if rcode != 0:
+        return None
+    revision = out.strip().rstrip("+")
+    rcode, out, err = _execute_and_capture_output(_hg(directory, "status"))
+    if rcode != 0:
+        return None
+    return revision, out
+
+
+def hg_get_remote_revision(url, branch):
+    rcode, out, err = _execute_and_capture_output(
+        [eos.tools.command_hg(), "identify", "--debug", "-i", "-r", branch, url]
+    )
+    if rcode != 0:
+        return None
+    return out.strip()
+
+
 # -----
 
 
-def git_clone(url, directory):
-    return _execute(eos.tools.command_git() + " clone --recursive " + url + " " + directory)
+def _git_fetch_options(depth=None, clone_filter=None):
+    options = []
+    if depth:
+        options += ["--depth", str(depth)]
+    if clone_filter:
+        options += ["--filter=" + clone_filter]
+    return options
+
+
+def git_clone(url, directory, branch=None, depth=None, clone_filter=None, single_branch=False, reference=None):
+    options = _git_fetch_options(depth, clone_filter)
+    if reference:
+        options += ["--reference-if-able", reference]
+    if single_branch:
+        options += ["--single-branch"]
+    if branch:
+        options += ["--branch", branch]
+    return _execute([eos.tools.command_git(), "clone", "--recursive"] + options + [url, directory])
+
+
+def git_clone_mirror(url, directory):
+    return _execute([eos.tools.command_git(), "clone", "--mirror", url, directory])
+
 
+def git_update_mirror(directory):
+    return _execute(_git(directory, "remote", "update", "--prune"))
 
-def git_fetch(directory):
-    return _execute(eos.tools.command_git() + " -C " + directory + " fetch --recurse-submodules")
+
+def git_init(url, directory):
+    status = _execute([eos.tools.command_git(), "init", "-q", directory])
+    if status != 0:
+        return status
+    return _execute(_git(directory, "remote", "add", "origin", url))
+
+
+def git_is_shallow(directory):
+    return os.path.exists(os.path.join(directory, ".git", "shallow"))
+
+
+def git_fetch(directory, depth=None, unshallow=False):
+    options = ["--unshallow"] if unshallow else _git_fetch_options(depth)
+    return _execute(_git(directory, "fetch", "--recurse-submodules", *options))
+
+
+def git_fetch_revision(directory, revision, depth=None, clone_filter=None):
+    # fetches only the given revision into FETCH_HEAD; needs server support when revision is a commit hash
+    options = _git_fetch_options(depth, clone_filter)
+    return _execute(_git(directory, "fetch", *options, "origin", revision))
 
 
 def git_pull(directory):
-    return _execute(eos.tools.command_git() + " -C " + directory + " pull --recurse-submodules")
+    return _execute(_git(directory, "pull", "--recurse-submodules"))
 
 
 def git_clean(directory):
-    return _execute(eos.tools.command_git() + " -C " + directory + " clean -fxd")
+    return _execute(_git(directory, "clean", "-fxd"))
 
 
 def git_checkout(directory, branch=None):
-    if branch is None:
-        branch = ""  # making this effectively a no-op
-    return _execute(eos.tools.command_git() + " -C " + directory + " checkout " + branch)
+    # without a branch, this is effectively a no-op
+    return _execute(_git(directory, "checkout", *([branch] if branch else [])))
+
+
+def git_has_commit(directory, revision):
+    return eos.session.get_git_session(directory).resolve(revision + "^{commit}") is not None
+
 
+def git_has_submodules(directory):
+    return os.path.exists(os.path.join(directory, ".gitmodules"))
 
-def git_submodule_update(directory):
-    return _execute(eos.tools.command_git() + " -C " + directory + " submodule update")
+
+def git_submodule_update(directory, init=False, depth=None):
+    options = ["--init", "--recursive"] if init else []
+    if depth:
+        options += ["--depth", str(depth)]
+    return _execute(_git(directory, "submodule", "update", *options))
 
 
 def git_reset_to_revision(directory, revision=None):
     if revision is None:
         revision = "HEAD"
-    return _execute(eos.tools.command_git() + " -C " + directory + " reset --hard " + revision)
+    return _execute(_git(directory, "reset", "--hard", revision))
 
 
 def git_verify_commit_hash(directory, expected_commit_hash):
-    rcode, out, err = _execute_and_capture_output(eos.tools.command_git() + " -C " + directory + " rev-parse HEAD")
-    if rcode != 0:
+    current_commit_hash = eos.session.get_git_session(directory).resolve("HEAD")
+    if current_commit_hash is None:
         return False
-    current_commit_hash = out
     hash_match = expected_commit_hash in current_commit_hash
     return hash_match
 
 
+def git_get_working_state(directory):
+    # one process gives both the checked out commit and the status of the working tree
+    rcode, out, err = _execute_and_capture_output(_git(directory, "status", "--porcelain=v2", "--branch"))
+    if rcode != 0:
+        return None
+    revision = None
+    status_lines = []
+    for line in out.splitlines():
+        if line.startswith("# branch.oid "):
+            revision = line[len("# branch.oid ") :]
+        elif not line.startswith("#"):
+            status_lines.append(line)
+    if not eos.util.is_sha1(revision):
+        return None
+    return revision, "\n".join(status_lines)
+
+
+def git_get_remote_revision(url, branch):
+    rcode, out, err = _execute_and_capture_output([eos.tools.command_git(), "ls-remote", url, "refs/heads/" + branch])
+    if rcode != 0 or not out.strip():
+        return None
+    return out.split()[0]
+
+
 # -----
 
 
 def svn_checkout(url, directory):
-    return _execute(eos.tools.command_svn() + " checkout " + url + " " + directory)
+    return _execute([eos.tools.command_svn(), "checkout", url, directory])
 
 
 # -----
 
 
-def update_state_git(url, dst_dir, branch=None, revision=None):
-    if not git_repo_exists(dst_dir):
+def _get_mirror_lock(mirror_dir):
+    with _MIRROR_LOCKS_LOCK:
+        return _MIRROR_LOCKS.setdefault(mirror_dir, threading.Lock())
+
+
+def _update_mirror_locked(repo_type, url, mirror_dir):
+    if os.path.exists(mirror_dir):
+        if repo_type == "git":
+            return git_update_mirror(mirror_dir) == 0
+        return hg_pull(mirror_dir) == 0
+
+    # create the mirror under a temporary name first, such that other runs never see an incomplete one
+    tmp_mirror_dir = mirror_dir + ".tmp"
+    _remove_directory(tmp_mirror_dir)
+    if repo_type == "git":
+        if git_clone_mirror(url, tmp_mirror_dir) != 0:
+            return False
+        # checkouts borrow objects from the mirror, so it must never drop any of them
+        _execute(_git(tmp_mirror_dir, "config", "gc.auto", "0"))
+        _execute(_git(tmp_mirror_dir, "config", "gc.pruneExpire", "never"))
+    else:
+        if _execute([eos.tools.command_hg(), "clone", "-U", url, tmp_mirror_dir]) != 0:
+            return False
+    os.rename(tmp_mirror_dir, mirror_dir)
+    return True
+
+
+def update_mirror(repo_type, url):
+    # Creates or refreshes the mirror of the given repository in the mirror cache, at most once per run.
+    # Returns the mirror directory, or None if there is no mirror cache or the mirror could not be updated.
+    if eos.cache.get_mirror_cache_dir() is None or url is None:
+        return None
+
+    mirror_dir = eos.cache.get_mirror_dir(repo_type, url)
+    with _get_mirror_lock(mirror_dir):
+        if mirror_dir in _MIRRORS_REFRESHED:
+            return mirror_dir
+
+        eos.log_verbose("Updating mirror of " + url + " in " + mirror_dir)
+        os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+        lock_file = open(mirror_dir + ".lock", "w")
+        try:
+            # other eos processes on the same machine might be updating the same mirror
+            if FCNTL_AVAILABLE:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            success = _update_mirror_locked(repo_type, url, mirror_dir)
+        finally:
+            lock_file.close()
+
+        if not success:
+            eos.log_warning("updating mirror of " + url + " failed; not using mirror")
+            return None
+        _MIRRORS_REFRESHED.add(mirror_dir)
+        return mirror_dir
+
+
+def _is_commit_hash(revision):
+    # (possibly abbreviated) commit hashes are immutable, unlike branch or tag names
+    if not revision or len(revision) < 7 or len(revision) > 40:
+        return False
+    try:
+        int(revision, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def update_state_git(url, dst_dir, branch=None, revision=None, depth=None, clone_filter=None, single_branch=False):
+    # With a depth given, a pinned revision is fetched on its own ('fetch origin <revision> --depth N'), instead of
+    # cloning or fetching the whole history. If the server refuses that, we fall back to a regular clone or fetch.
+    fetched_revision = False
+
+    # A commit hash that is already in the local object store needs no network access at all. The check also tells us
+    # that the repository exists, which saves a separate process for git_repo_exists().
+    has_revision = (
+        _is_commit_hash(revision)
+        and os.path.exists(os.path.join(dst_dir, ".git"))
+        and git_has_commit(dst_dir, revision)
+    )
+
+    if not has_revision and not git_repo_exists(dst_dir):
         if url is None:
             return False
         _remove_directory(dst_dir)
-        _check_return_code(git_clone(url, dst_dir))
+        if revision and depth:
+            fetched_revision = (
+                git_init(url, dst_dir) == 0 and git_fetch_revision(dst_dir, revision, depth, clone_filter) == 0
+            )
+            if not fetched_revision:
+                eos.log_verbose("Fetching single revision failed; cloning repository instead")
+                _remove_directory(dst_dir)
+        if not fetched_revision:
+            # shallow clones do not benefit from a full mirror
+            mirror_dir = update_mirror("git", url) if not depth else None
+            _check_return_code(
+                git_clone(
+                    url,
+                    dst_dir,
+                    branch=None if revision else branch,
+                    depth=None if revision else depth,
+                    clone_filter=clone_filter,
+                    single_branch=single_branch,
+                    reference=mirror_dir,
+                )
+            )
     else:
         _check_return_code(git_clean(dst_dir))
-        if url is not None:
-            _check_return_code(git_fetch(dst_dir))
+        if has_revision:
+            eos.log_verbose("Revision " + revision + " already present; skipping fetch")
+        elif url is not None:
+            if not depth:
+                update_mirror("git", url)  # so that the following fetch finds most objects through the alternates
+            if revision and depth:
+                fetched_revision = git_fetch_revision(dst_dir, revision, depth, clone_filter) == 0
+            if not fetched_revision:
+                # a shallow repository needs its full history to reach an arbitrary revision
+                unshallow = bool(revision) and git_is_shallow(dst_dir)
+                _check_return_code(git_fetch(dst_dir, depth=None if revision else depth, unshallow=unshallow))
 
     if revision and revision != "":
-        _check_return_code(git_reset_to_revision(dst_dir, revision))
+        _check_return_code(git_reset_to_revision(dst_dir, "FETCH_HEAD" if fetched_revision else revision))
     else:
         if not branch or branch == "":
             branch = "master"
         _check_return_code(git_checkout(dst_dir, branch))
         if url is not None:
-            _check_return_code(git_pull(dst_dir))
-    _check_return_code(git_submodule_update(dst_dir))
-
-    if eos.util.is_sha1(revision) and not git_verify_commit_hash(dst_dir, revision):
+            if depth:
+                # pulling into a shallow repository can fail on seemingly unrelated histories; move to the fetched head
+                _check_return_code(git_reset_to_revision(dst_dir, "origin/" + branch))
+            else:
+                _check_return_code(git_pull(dst_dir))
+    if git_has_submodules(dst_dir):
+        _check_return_code(
+            git_submodule_update(dst_dir, init=fetched_revision, depth=depth if fetched_revision else None)
+        )
+
+    # after a successful 'reset --hard <sha1>', HEAD is known to be at that commit; only FETCH_HEAD needs checking
+    if eos.util.is_sha1(revision) and fetched_revision and not git_verify_commit_hash(dst_dir, revision):
         eos.log_error("SHA1 hash check failed")
         return False
     return True
@@ -158,10 +432,18 @@ def update_state_hg(url, dst_dir, branch=None, revision=None):
         if url is None:
             return False
         _remove_directory(dst_dir)
-        _check_return_code(hg_clone(url, dst_dir))
+        mirror_dir = update_mirror("hg", url)
+        if mirror_dir:
+            # the checkout shares the store of the (already refreshed) mirror, so later pulls find nothing new
+            _check_return_code(hg_share(mirror_dir, dst_dir))
+        else:
+            _check_return_code(hg_clone(url, dst_dir))
     else:
         _check_return_code(hg_purge(dst_dir))
-        if url is not None:
+        if _is_commit_hash(revision) and hg_has_revision(dst_dir, revision):
+            eos.log_verbose("Revision " + revision + " already present; skipping pull")
+        elif url is not None:
+            update_mirror("hg", url)
             _check_return_code(hg_pull(dst_dir))
 
     if revision and revision != "":
@@ -187,7 +469,9 @@ def update_state_svn(url, dst_dir, revision=None):
     return True
 
 
-def update_state(repo_type, url, name, dst_dir, branch=None, revision=None):
+def update_state(
+    repo_type, url, name, dst_dir, branch=None, revision=None, depth=None, clone_filter=None, single_branch=False
+):
     eos.log_verbose(
         "Updating repository for '"
         + name
@@ -200,7 +484,15 @@ def update_state(repo_type, url, name, dst_dir, branch=None, revision=None):
 
     try:
         if repo_type == "git":
-            success = update_state_git(url, dst_dir, branch=branch, revision=revision)
+            success = update_state_git(
+                url,
+                dst_dir,
+                branch=branch,
+                revision=revision,
+                depth=depth,
+                clone_filter=clone_filter,
+                single_branch=single_branch,
+            )
         elif repo_type == "hg":
             success = update_state_hg(url, dst_dir, branch=branch, revision=revision)
         elif repo_type == "svn":
@@ -213,5 +505,50 @@ def update_state(repo_type, url, name, dst_dir, branch=None, revision=None):
             return False
     except RuntimeError:
         return False
+    finally:
+        eos.session.close_git_session(dst_dir)
 
     return success
+
+
+def restore_revision(repo_type, dst_dir, revision):
+    # Resets the working tree to a revision that is available locally, discarding all changes (e.g. by post-processing),
+    # without network access. Repositories with submodules are not handled, since these might need fetching.
+    try:
+        if repo_type == "git" and git_repo_exists(dst_dir) and not git_has_submodules(dst_dir):
+            _check_return_code(git_reset_to_revision(dst_dir, revision))
+            _check_return_code(git_clean(dst_dir))
+        elif repo_type == "hg" and hg_repo_exists(dst_dir):
+            _check_return_code(hg_purge(dst_dir))
+            _check_return_code(hg_update_to_revision(dst_dir, revision))
+        else:
+            return False
+    except RuntimeError:
+        return False
+    finally:
+        eos.session.close_git_session(dst_dir)
+    return True
+
+
+def get_working_state(repo_type, dst_dir):
+    # Returns a dict with the checked out revision and a hash of the working tree status (which includes files changed
+    # or added by post-processing), or None if it cannot be determined.
+    if repo_type == "git" and os.path.exists(os.path.join(dst_dir, ".git")):
+        state = git_get_working_state(dst_dir)
+    elif repo_type == "hg" and hg_repo_exists(dst_dir):
+        state = hg_get_working_state(dst_dir)
+    else:
+        return None
+    if state is None:
+        return None
+    revision, status = state
+    return {"revision": revision, "status": hashlib.sha1(status.encode("utf-8")).hexdigest()}
+
+
+def get_remote_revision(repo_type, url, branch):
+    # Returns the commit hash of the head of the given branch in the remote repository, or None.
+    if repo_type == "git":
+        return git_get_remote_revision(url, branch or "master")
+    elif repo_type == "hg":
+        return hg_get_remote_revision(url, branch or "default")
+    return None
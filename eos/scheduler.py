@@ -0,0 +1,96 @@
+import concurrent.futures
+
+import eos.log
+
+
+def _log_cycle(parents, name, dependency):
+    # the path from the dependency to the name depending on it, via the names in between
+    cycle = [name]
+    while cycle[-1] != dependency:
+        cycle.append(parents[cycle[-1]])
+    cycle.reverse()
+    eos.log_error("dependency cycle detected: " + " -> ".join(cycle + [dependency]))
+
+
+def sort_topologically(names, dependencies):
+    # Returns the given names ordered such that each name comes after all of its dependencies; the original order is
+    # kept as far as possible. Dependencies that are not part of 'names' are ignored. Returns None on cycles.
+    # Iterative depth-first search, such that long dependency chains do not hit the recursion limit.
+    names_set = set(names)
+    sorted_names = []
+    state = {}  # name -> "visiting" or "done"
+    parents = {}  # name -> the name on the current path that depends on it
+
+    for root in names:
+        if root in state:
+            continue
+        state[root] = "visiting"
+        stack = [(root, iter(dependencies.get(root, [])))]
+        while stack:
+            name, remaining_dependencies = stack[-1]
+            for dependency in remaining_dependencies:
+                if dependency not in names_set or state.get(dependency) == "done":
+                    continue
+                if state.get(dependency) == "visiting":
+                    _log_cycle(parents, name, dependency)
+                    return None
+                state[dependency] = "visiting"
+                parents[dependency] = name
+                stack.append((dependency, iter(dependencies.get(dependency, []))))
+                break
+            else:
+                stack.pop()
+                state[name] = "done"
+                sorted_names.append(name)
+    return sorted_names
+
+
+def run(names, dependencies, function, jobs=1):
+    # Generator calling function(name) for each name in 'names' (which need to be sorted topologically), and
+    # yielding (name, success) in order of completion. Each name is started as soon as all of its dependencies
+    # have finished successfully; if a dependency failed, function(name) is not called and (name, None) is yielded.
+    names_set = set(names)
+    required = {name: set(d for d in dependencies.get(name, []) if d in names_set) for name in names}
+    finished = set()
+    failed = set()
+
+    if jobs <= 1:
+        for name in names:
+            if required[name] & failed:
+                failed.add(name)
+                yield name, None
+                continue
+            success = function(name)
+            if not success:
+                failed.add(name)
+            yield name, success
+        return
+
+    pending = list(names)
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # start everything whose dependencies are done; iterating in topological order makes sure that
+            # failures propagate to all dependents in a single pass
+            for name in list(pending):
+                if required[name] & failed:
+                    pending.remove(name)
+                    failed.add(name)
+                    finished.add(name)
+                    yield name, None
+                elif required[name] <= finished:
+                    pending.remove(name)
+                    running[executor.submit(function, name)] = name
+
+            if not running:
+                continue
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                success = future.result()
+                finished.add(name)
+                if not success:
+                    failed.add(name)
+                yield name, success
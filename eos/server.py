@@ -0,0 +1,194 @@
+import email.utils
+import html
+import http
+import http.server
+import io
+import os
+import urllib.parse
+
+import eos.constants
+import eos.log
+
+# Serves the archives and snapshots of a bootstrapping directory, such that it can be used as fallback URL by other
+# machines. Only the '.cache/archives' and '.cache/snapshots' trees are exposed (plus listings of their parents).
+
+# files being written (downloads, snapshots, indices) are never served, nor the validators of partial downloads
+_PARTIAL_FILE_EXTENSIONS = (".part", ".tmp", ".part" + eos.constants.DOWNLOAD_VALIDATORS_SUFFIX)
+
+
+def _is_served_path(relative_path):
+    parts = [part for part in relative_path.replace(os.path.sep, "/").split("/") if part and part != "."]
+    if not parts:
+        return True
+    if parts[0] != eos.constants.CACHE_DIR_REL:
+        return False
+    if len(parts) == 1:
+        return True
+    if parts[1] not in [eos.constants.ARCHIVE_SUBDIR_REL, eos.constants.SNAPSHOT_SUBDIR_REL]:
+        return False
+    return not parts[-1].endswith(_PARTIAL_FILE_EXTENSIONS)
+
+
+def _get_etag(st):
+    return '"' + format(st.st_size, "x") + "-" + format(st.st_mtime_ns, "x") + '"'
+
+
+def _parse_range(range_header, size):
+    # Returns (start, end) for a single byte range, None to send the whole file (no or unsupported Range header), or
+    # False if the range is not satisfiable.
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes=") :].strip().partition("-")
+    try:
+        if not start:
+            # suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class CacheRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as used by the connection pool of eos.net
+
+    def log_message(self, format, *args):
+        eos.log_verbose(self.address_string() + " - " + (format % args))
+
+    def _send_not_found(self):
+        self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+        return None
+
+    def send_head(self):
+        self.range_start, self.range_length = 0, None  # the handler is reused for requests on the same connection
+        path = self.translate_path(self.path)
+        if not _is_served_path(os.path.relpath(path, self.directory)):
+            return self._send_not_found()
+        if os.path.isdir(path):
+            return super().send_head()  # redirect or directory listing
+        if urllib.parse.urlsplit(self.path).path.endswith("/"):
+            return self._send_not_found()
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return self._send_not_found()
+        try:
+            return self._send_file_head(path, f)
+        except:
+            f.close()
+            raise
+
+    def _send_file_head(self, path, f):
+        st = os.fstat(f.fileno())
+        etag = _get_etag(st)
+
+        if_none_match = self.headers.get("If-None-Match", None)
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            f.close()
+            return None
+
+        byte_range = _parse_range(self.headers.get("Range", None), st.st_size)
+        if_range = self.headers.get("If-Range", None)
+        if byte_range is not None and if_range and if_range.strip() != etag:
+            byte_range = None  # the file changed since the client got its first part; send all of it
+        if byte_range is False:
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", "bytes */" + str(st.st_size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            f.close()
+            return None
+
+        if byte_range is None:
+            self.send_response(http.HTTPStatus.OK)
+            self.range_start, self.range_length = 0, st.st_size
+        else:
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            start, end = byte_range
+            self.send_header("Content-Range", "bytes " + str(start) + "-" + str(end) + "/" + str(st.st_size))
+            self.range_start, self.range_length = start, end - start + 1
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(self.range_length))
+        self.send_header("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.range_length is None:
+            super().copyfile(source, outputfile)  # e.g. a directory listing
+            return
+        outputfile.flush()
+        try:
+            # zero-copy transfer where the platform supports it (os.sendfile); plain send() otherwise
+            self.connection.sendfile(source, self.range_start, self.range_length)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def list_directory(self, path):
+        # only list what is served, i.e. hide library directories and partially written files
+        relative_dir = os.path.relpath(path, self.directory)
+        try:
+            names = sorted(name for name in os.listdir(path) if _is_served_path(os.path.join(relative_dir, name)))
+        except OSError:
+            return self._send_not_found()
+
+        title = "Index of " + html.escape(urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        lines = ['<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>' + title + "</title></head><body>"]
+        lines.append("<h1>" + title + "</h1>\n<ul>")
+        for name in names:
+            link = name + "/" if os.path.isdir(os.path.join(path, name)) else name
+            lines.append('<li><a href="' + urllib.parse.quote(link) + '">' + html.escape(link) + "</a></li>")
+        lines.append("</ul>\n</body></html>\n")
+        data = "\n".join(lines).encode("utf-8")
+
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
+
+
+def serve(directory, host="", port=eos.constants.SERVE_PORT):
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(os.path.join(directory, eos.constants.CACHE_DIR_REL)):
+        eos.log_error(
+            "'" + directory + "' is not a bootstrapping directory (missing " + eos.constants.CACHE_DIR_REL + ")"
+        )
+        return -1
+
+    def create_handler(*args, **kwargs):
+        return CacheRequestHandler(*args, directory=directory, **kwargs)
+
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), create_handler)
+    except OSError as e:
+        eos.log_error("could not listen on " + (host or "all interfaces") + ", port " + str(port) + ": " + str(e))
+        return -1
+    server.daemon_threads = True
+    eos.log(
+        "Serving archives and snapshots of "
+        + directory
+        + " on port "
+        + str(server.server_address[1])
+        + "; use as --fallback-url http://<host>:"
+        + str(server.server_address[1])
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -0,0 +1,174 @@
+import atexit
+import os
+import struct
+import subprocess
+import threading
+
+import eos.log
+import eos.tools
+
+# Long-running helper processes, which answer many requests without starting a new process (and, for hg, a new Python
+# interpreter) each time: Mercurial command servers ('hg serve --cmdserver pipe'), and one 'git cat-file --batch-check'
+# process per repository for object queries.
+
+# idle hg command servers; a server runs one command at a time, so concurrent callers each get their own
+_HG_SERVERS = []
+_HG_SERVERS_LOCK = threading.Lock()
+HG_SERVER_AVAILABLE = True
+
+# 'git cat-file' sessions, per repository directory
+_GIT_SESSIONS = {}
+_GIT_SESSIONS_LOCK = threading.Lock()
+
+
+class HgCommandServer(object):
+    # Client for the Mercurial command server protocol; see 'hg help internals.cmdserver'.
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [eos.tools.command_hg(), "serve", "--cmdserver", "pipe", "--config", "ui.interactive=False"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        channel, data = self._read_channel()
+        if channel != b"o" or b"runcommand" not in data:
+            self.close()
+            raise IOError("unexpected hello message from hg command server")
+
+    def _read_exactly(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise IOError("hg command server terminated unexpectedly")
+        return data
+
+    def _read_channel(self):
+        channel, length = struct.unpack(">cI", self._read_exactly(5))
+        if channel in b"IL":
+            return channel, length  # input requested; the length is the maximum size that may be sent
+        return channel, self._read_exactly(length)
+
+    def run_command(self, args):
+        # runs 'hg <args>', and returns the exit code and the output on stdout and stderr
+        data = b"\0".join(arg.encode() for arg in args)
+        self.process.stdin.write(b"runcommand\n" + struct.pack(">I", len(data)) + data)
+        self.process.stdin.flush()
+
+        out = []
+        err = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == b"o":
+                out.append(data)
+            elif channel == b"e":
+                err.append(data)
+            elif channel == b"r":
+                exit_code = struct.unpack(">i", data)[0]
+                return exit_code, b"".join(out).decode(errors="replace"), b"".join(err).decode(errors="replace")
+            elif channel in b"IL":
+                self.process.stdin.write(struct.pack(">I", 0))  # there is no input to give
+                self.process.stdin.flush()
+            elif channel.isupper():
+                raise IOError("unsupported hg command server channel " + channel.decode())
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+def _acquire_hg_server():
+    global HG_SERVER_AVAILABLE
+    with _HG_SERVERS_LOCK:
+        if _HG_SERVERS:
+            return _HG_SERVERS.pop()
+        if not HG_SERVER_AVAILABLE:
+            return None
+    try:
+        return HgCommandServer()
+    except (IOError, OSError) as e:
+        eos.log_verbose("hg command server not available (" + str(e) + "); running hg commands one by one", level=2)
+        HG_SERVER_AVAILABLE = False
+        return None
+
+
+def run_hg_command(args):
+    # Runs 'hg <args>' in a command server; returns the exit code and the output on stdout and stderr, or None if no
+    # command server could be started, in which case the caller has to run the command as a separate process.
+    server = _acquire_hg_server()
+    if server is None:
+        return None
+
+    try:
+        result = server.run_command(args)
+    except (IOError, OSError) as e:
+        # do not rerun the command, as it might have been executed partially
+        server.close()
+        return 255, "", "hg command server failed: " + str(e) + "\n"
+
+    with _HG_SERVERS_LOCK:
+        _HG_SERVERS.append(server)
+    return result
+
+
+class GitObjectSession(object):
+    # Resolves object names in a repository through a single 'git cat-file --batch-check' process.
+    def __init__(self, directory):
+        self.process = subprocess.Popen(
+            [eos.tools.command_git(), "-C", directory, "cat-file", "--batch-check"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+
+    def resolve(self, name):
+        # returns the object ID for the given name, or None if there is no such object
+        try:
+            self.process.stdin.write(name + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (OSError, ValueError):
+            return None
+        fields = line.split()
+        if len(fields) != 3:
+            return None  # '<name> missing' or '<name> ambiguous'
+        return fields[0]
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+def get_git_session(directory):
+    directory = os.path.abspath(directory)
+    with _GIT_SESSIONS_LOCK:
+        session = _GIT_SESSIONS.get(directory, None)
+        if session is None:
+            session = GitObjectSession(directory)
+            _GIT_SESSIONS[directory] = session
+        return session
+
+
+def close_git_session(directory):
+    with _GIT_SESSIONS_LOCK:
+        session = _GIT_SESSIONS.pop(os.path.abspath(directory), None)
+    if session is not None:
+        session.close()
+
+
+def close_sessions():
+    with _GIT_SESSIONS_LOCK:
+        sessions = list(_GIT_SESSIONS.values())
+        _GIT_SESSIONS.clear()
+    with _HG_SERVERS_LOCK:
+        sessions += _HG_SERVERS
+        del _HG_SERVERS[:]
+    for session in sessions:
+        session.close()
+
+
+atexit.register(close_sessions)
@@ -1,14 +1,92 @@
-def check_equals(state, name, lib_obj):
-    if not state:
-        return False
+import json
+import os
 
-    for state_obj in state:
-        state_name = state_obj.get("name", None)
-        if state_name and state_name == name and state_obj == lib_obj:
-            return True
-    return False
+import eos.json
+import eos.log
 
+# key under which additional information about a bootstrapped library (e.g. the checked out commit) is stored in its
+# state object; it is ignored when comparing against the library object from the JSON file
+METADATA_KEY = "_eos"
 
-def remove_library(state, name):
-    if state:
-        state[:] = [s for s in state if not s.get("name", None) == name]
+
+class State(object):
+    # In-memory state of bootstrapped libraries, indexed by library name.
+    # Changes are appended to a journal file right away, and the state file itself is only rewritten on write();
+    # if a run is interrupted before that, the journal is replayed on the next read().
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.libraries = {}
+        self.modified = False
+
+    def read(self):
+        data = eos.json.read_file(self.filename)
+        self.libraries = eos.json.get_library_index(data if isinstance(data, list) else [])
+        self.modified = False
+        self._replay_journal()
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return
+
+        with open(self.journal_filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # incomplete last entry of an interrupted run
+                self._apply(entry)
+        self.modified = True
+
+    def _apply(self, entry):
+        operation = entry.get("op", None)
+        if operation == "add":
+            obj = entry["library"]
+            self.libraries.pop(obj["name"], None)
+            self.libraries[obj["name"]] = obj
+        elif operation == "remove":
+            self.libraries.pop(entry["name"], None)
+        elif operation == "clear":
+            self.libraries = {}
+
+    def _record(self, entry):
+        self._apply(entry)
+        self.modified = True
+        with open(self.journal_filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def check_equals(self, name, lib_obj):
+        state_obj = self.libraries.get(name, None)
+        if state_obj is None:
+            return False
+        return {k: v for k, v in state_obj.items() if k != METADATA_KEY} == lib_obj
+
+    def get_metadata(self, name):
+        state_obj = self.libraries.get(name, None)
+        if state_obj is None:
+            return {}
+        return state_obj.get(METADATA_KEY, {})
+
+    def add_library(self, lib_obj, metadata=None):
+        if metadata:
+            lib_obj = dict(lib_obj)
+            lib_obj[METADATA_KEY] = metadata
+        self._record({"op": "add", "library": lib_obj})
+
+    def remove_library(self, name):
+        if name in self.libraries:
+            self._record({"op": "remove", "name": name})
+
+    def clear(self):
+        self._record({"op": "clear"})
+
+    def write(self):
+        if not self.modified:
+            return
+        eos.json.write_file_atomic(self.filename, list(self.libraries.values()))
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.modified = False
@@ -1,5 +1,6 @@
 import platform
 import os
+import shutil
 
 
 COMMAND_GIT = "git"
@@ -8,6 +9,12 @@ COMMAND_SVN = "svn"
 COMMAND_PYTHON = "python"
 COMMAND_PATCH = "patch"
 
+# optional commands; these are None if not available
+COMMAND_XZ = None
+COMMAND_PIGZ = None
+COMMAND_PBZIP2 = None
+COMMAND_ZSTD = None
+
 
 def _find_command(command, paths_to_search):
     command_res = command
@@ -30,15 +37,26 @@ def initialize_commands():
     global COMMAND_SVN
     global COMMAND_PYTHON
     global COMMAND_PATCH
+    global COMMAND_XZ
+    global COMMAND_PIGZ
+    global COMMAND_PBZIP2
+    global COMMAND_ZSTD
 
     if platform.system() is not "Windows":
         # we search in the PATH as well as in some obvious locations
         paths_to_search = os.environ["PATH"].split(":") + ["/usr/local/bin", "/opt/local/bin", "/usr/bin"]
-        COMMAND_GIT = _sanitize_command(_find_command(COMMAND_GIT, paths_to_search))
-        COMMAND_HG = _sanitize_command(_find_command(COMMAND_HG, paths_to_search))
-        COMMAND_SVN = _sanitize_command(_find_command(COMMAND_SVN, paths_to_search))
+        COMMAND_GIT = _find_command(COMMAND_GIT, paths_to_search)
+        COMMAND_HG = _find_command(COMMAND_HG, paths_to_search)
+        COMMAND_SVN = _find_command(COMMAND_SVN, paths_to_search)
+        # the Python command is used in shell command lines for post-processing scripts; all other commands are
+        # executed directly as argument lists, and must not be escaped
         COMMAND_PYTHON = _sanitize_command(_find_command(COMMAND_PYTHON, paths_to_search))
-        COMMAND_PATCH = _sanitize_command(_find_command(COMMAND_PATCH, paths_to_search))
+        COMMAND_PATCH = _find_command(COMMAND_PATCH, paths_to_search)
+
+    COMMAND_XZ = shutil.which("xz")
+    COMMAND_PIGZ = shutil.which("pigz")
+    COMMAND_PBZIP2 = shutil.which("pbzip2")
+    COMMAND_ZSTD = shutil.which("zstd")
 
 
 def command_git():
@@ -59,3 +77,19 @@ def command_python():
 
 def command_patch():
     return COMMAND_PATCH
+
+
+def command_xz():
+    return COMMAND_XZ
+
+
+def command_pigz():
+    return COMMAND_PIGZ
+
+
+def command_pbzip2():
+    return COMMAND_PBZIP2
+
+
+def command_zstd():
+    return COMMAND_ZSTD
@@ -0,0 +1,74 @@
+import contextlib
+import os
+import threading
+import time
+
+import eos.json
+
+# Timing spans in the Chrome trace event format, which can be loaded in Perfetto or chrome://tracing.
+# Tracing is off unless enabled; spans are then no-ops.
+
+TRACE_EVENTS = None
+_TRACE_EVENTS_LOCK = threading.Lock()
+_TRACED_THREADS = set()
+_START_TIME = time.perf_counter()
+
+
+def enable_tracing():
+    global TRACE_EVENTS
+    TRACE_EVENTS = []
+
+
+def is_tracing():
+    return TRACE_EVENTS is not None
+
+
+def _get_timestamp():
+    # microseconds since the start of the run
+    return (time.perf_counter() - _START_TIME) * 1e6
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    # Records the duration of the enclosed block. Yields the dict of span arguments, which the block can add to
+    # (e.g. byte counts or cache hits); the arguments end up in the trace.
+    if TRACE_EVENTS is None:
+        yield args
+        return
+
+    start = _get_timestamp()
+    try:
+        yield args
+    finally:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": _get_timestamp() - start,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _TRACE_EVENTS_LOCK:
+            if event["tid"] not in _TRACED_THREADS:
+                # name the thread, such that concurrently bootstrapped libraries are told apart
+                _TRACED_THREADS.add(event["tid"])
+                TRACE_EVENTS.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": event["pid"],
+                        "tid": event["tid"],
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+            TRACE_EVENTS.append(event)
+
+
+def write_trace(filename):
+    if TRACE_EVENTS is None:
+        return
+    with _TRACE_EVENTS_LOCK:
+        events = list(TRACE_EVENTS)
+    eos.json.write_file_atomic(filename, {"traceEvents": events, "displayTimeUnit": "ms"})
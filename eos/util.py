@@ -1,4 +1,6 @@
+import concurrent.futures
 import hashlib
+import http.client
 import os
 import shlex
 import subprocess
@@ -12,48 +14,83 @@ try:
 except ImportError:
     SCP_AVAILABLE = False
 
+import eos.cache
+import eos.constants
+import eos.json
 import eos.log
+import eos.net
+import eos.trace
 
 
-def execute_command(command, print_command=False, quiet=False):
+def format_command(command):
+    if isinstance(command, str):
+        return command
+    return " ".join(shlex.quote(arg) for arg in command)
+
+
+def execute_command(command, print_command=False, quiet=False, stdin=None):
+    # A command given as list of arguments is executed directly; a command string is run by the shell (e.g. for
+    # user-provided post-processing scripts).
     if print_command:
-        eos.log("> " + command)
+        eos.log("> " + format_command(command))
+
+    shell = isinstance(command, str)
 
-    out = None
-    err = None
     if quiet:
-        out = open(os.devnull, "w")
-        err = open(os.devnull, "w")
+        return subprocess.call(command, shell=shell, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-    return subprocess.call(command, shell=True, stdout=out, stderr=err)
+    if eos.is_log_buffering():
+        # capture the output, such that it ends up in the log buffer of the current thread
+        proc = subprocess.run(command, shell=shell, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.stdout:
+            eos.log_output(proc.stdout.decode(errors="replace"))
+        return proc.returncode
+
+    return subprocess.call(command, shell=shell, stdin=stdin)
 
 
 def execute_command_capture_output(command, print_command=False):
     # https://pythonadventures.wordpress.com/2014/01/08/capture-the-exit-code-the-stdout-and-the-stderr-of-an-external-command/
     if print_command:
-        eos.log("> " + command)
+        eos.log("> " + format_command(command))
 
-    args = shlex.split(command)
+    args = shlex.split(command) if isinstance(command, str) else command
 
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     out, err = proc.communicate()
     exit_code = proc.returncode
 
     return exit_code, out, err
 
 
-# http://stackoverflow.com/questions/22058048/hashing-a-file-in-python
-def _compute_sha1_hash(filename):
-    buf_size = 128 * 1024  # 128 kB chunks
-    sha1 = hashlib.sha1()
+BUFFER_SIZE = 128 * 1024  # 128 kB chunks
+
+# segmented downloads; files of at least the threshold size are fetched in this many parallel byte ranges
+DOWNLOAD_SEGMENTS = 1
+DOWNLOAD_SEGMENTS_THRESHOLD = 64 * 1024 * 1024
+
+
+def set_download_segments(segments, threshold=None):
+    global DOWNLOAD_SEGMENTS
+    global DOWNLOAD_SEGMENTS_THRESHOLD
+    DOWNLOAD_SEGMENTS = segments
+    if threshold is not None:
+        DOWNLOAD_SEGMENTS_THRESHOLD = threshold
+
 
+# http://stackoverflow.com/questions/22058048/hashing-a-file-in-python
+def _update_sha1_hash(sha1, filename):
     with open(filename, "rb") as f:
         while True:
-            data = f.read(buf_size)
+            data = f.read(BUFFER_SIZE)
             if not data:
                 break
             sha1.update(data)
 
+
+def compute_sha1_hash(filename):
+    sha1 = hashlib.sha1()
+    _update_sha1_hash(sha1, filename)
     return sha1.hexdigest()
 
 
@@ -90,10 +127,302 @@ def get_filename_from_url(url):
     return url_filename
 
 
-class _MyURLOpener(urllib.request.URLopener):
+def _write_response(response, f, sha1):
+    while True:
+        data = response.read(BUFFER_SIZE)
+        if not data:
+            break
+        sha1.update(data)
+        f.write(data)
+    # a connection closed early just ends the data; the length left of the response tells the bytes that are missing
+    if getattr(response, "length", None):
+        raise IOError("incomplete response (" + str(response.length) + " bytes missing)")
+
+
+def _download_url(url, target_filename, user_agent=None, validators=None):
+    # streams the URL contents to the target file, and returns the SHA1 hash of the data written;
+    # if the target file already exists from an interrupted download, the download is resumed where possible.
+    # The validators of the response (ETag, Last-Modified) are added to the given dict, if any; such a dict is passed
+    # for downloads without SHA1 hash.
+    headers = {}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+
+    sha1 = hashlib.sha1()
+
+    if not eos.net.is_http_url(url):
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            with open(target_filename, "wb") as f:
+                _write_response(response, f, sha1)
+        return sha1.hexdigest()
+
+    offset = os.path.getsize(target_filename) if os.path.exists(target_filename) else 0
+    partial_validators = _read_partial_validators(target_filename) if offset > 0 else {}
+    if offset > 0:
+        # the server sends the whole file instead of the range if it changed since the partial download started
+        if_range = _get_if_range(partial_validators)
+        if if_range:
+            headers["If-Range"] = if_range
+        elif validators is not None:
+            # without SHA1 hash, a resumed download of a file republished in between would go unnoticed
+            eos.log_verbose("Partial download " + target_filename + " cannot be validated; starting over")
+            _remove_partial_file(target_filename)
+            offset = 0
+    if offset > 0:
+        headers["Range"] = "bytes=" + str(offset) + "-"
+
+    with eos.net.request(url, headers) as response:
+        if response.status == 416:
+            # requested range not satisfiable; start over
+            response.read()
+            _remove_partial_file(target_filename)
+            return None
+        if response.status not in [200, 206]:
+            raise IOError("HTTP error " + str(response.status) + " (" + response.reason + ")")
+        response_validators = _get_validators(response)
+        if validators is not None:
+            validators.update(response_validators)
+
+        mode = "wb"
+        if response.status == 206:
+            if not response.getheader("Content-Range", "").startswith("bytes " + str(offset) + "-"):
+                _remove_partial_file(target_filename)
+                raise IOError("unexpected Content-Range in response")
+            if _has_changed(partial_validators, response_validators):
+                # a server ignoring If-Range; the partial download is of a different version of the file
+                eos.log_verbose("File " + url + " changed since the partial download; starting over")
+                _remove_partial_file(target_filename)
+                return None
+            eos.log_verbose("Resuming download at byte " + str(offset))
+            _update_sha1_hash(sha1, target_filename)
+            mode = "ab"
+        else:
+            # the validators of the version being downloaded, for resuming it later
+            _write_partial_validators(target_filename, response_validators)
+
+        with open(target_filename, mode) as f:
+            _write_response(response, f, sha1)
+
+    return sha1.hexdigest()
+
+
+def _get_ranged_download_size(url, headers, validators=None):
+    # returns the size of the file behind the URL, if the server supports byte range requests; None otherwise
+    with eos.net.request(url, headers, method="HEAD") as response:
+        if response.status != 200 or response.getheader("Accept-Ranges", "none") != "bytes":
+            return None
+        if validators is not None:
+            validators.update(_get_validators(response))
+        length = response.getheader("Content-Length", None)
+    return int(length) if length and length.isdigit() else None
+
+
+class _ChangedDuringDownload(IOError):
     pass
 
 
+def _download_range(url, headers, target_filename, start, end, validators):
+    # the validators of the HEAD request make sure that all segments are of the same version of the file
+    headers = dict(headers)
+    headers["Range"] = "bytes=" + str(start) + "-" + str(end)
+    if_range = _get_if_range(validators)
+    if if_range:
+        headers["If-Range"] = if_range
+    with eos.net.request(url, headers) as response:
+        if response.status == 200 and if_range:
+            raise _ChangedDuringDownload("file changed during segmented download")
+        if response.status != 206:
+            raise IOError("HTTP error " + str(response.status) + " (" + response.reason + ") for byte range")
+        if _has_changed(validators, _get_validators(response)):
+            raise _ChangedDuringDownload("file changed during segmented download")
+        with open(target_filename, "r+b") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = response.read(min(BUFFER_SIZE, remaining))
+                if not data:
+                    raise IOError("incomplete byte range " + str(start) + "-" + str(end))
+                f.write(data)
+                remaining -= len(data)
+
+
+def _download_url_segmented(url, target_filename, user_agent, segments, threshold=0, validators=None):
+    # downloads the URL in parallel byte ranges into a preallocated file; returns False if the server does not
+    # support range requests, the file is smaller than the threshold, or it changed during the download, in which case
+    # nothing was written (and it is to be downloaded as a single stream)
+    headers = {}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+
+    range_validators = {}
+    size = _get_ranged_download_size(url, headers, range_validators)
+    if not size or size < max(segments, threshold):
+        return False
+    if validators is not None and not _get_if_range(range_validators):
+        # without SHA1 hash, segments of a file republished in between could not be told apart
+        return False
+
+    eos.log_verbose("Downloading " + str(size) + " bytes in " + str(segments) + " segments")
+    with open(target_filename, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+    segment_size = (size + segments - 1) // segments
+    ranges = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(_download_range, url, headers, target_filename, s, e, range_validators)
+                for s, e in ranges
+            ]
+            for future in futures:
+                future.result()
+    except _ChangedDuringDownload as e:
+        eos.log_verbose("File " + url + ": " + str(e) + "; downloading it as a single stream")
+        _remove_partial_file(target_filename)
+        return False
+    except:
+        # a segmented file has holes, and cannot be resumed
+        _remove_partial_file(target_filename)
+        raise
+    if validators is not None:
+        validators.update(range_validators)
+    return True
+
+
+# -----
+# Files without SHA1 hash are revalidated with conditional requests instead: the validators of the response they were
+# downloaded with (ETag, Last-Modified, and the size) are stored in a file next to them.
+
+VALIDATOR_HEADERS = ["ETag", "Last-Modified"]
+
+
+def _get_validators(response):
+    return {header: response.getheader(header) for header in VALIDATOR_HEADERS if response.getheader(header, None)}
+
+
+def _get_validators_filename(filename):
+    return filename + eos.constants.DOWNLOAD_VALIDATORS_SUFFIX
+
+
+def _write_validators(filename, url, validators):
+    if not validators:
+        _remove_file(_get_validators_filename(filename))  # the server gives nothing to revalidate against
+        return
+    validators = dict(validators, url=url)
+    validators["Content-Length"] = str(os.path.getsize(filename))
+    eos.json.write_file_atomic(_get_validators_filename(filename), validators)
+
+
+def _read_validators(filename, url):
+    # returns the stored validators of a cached download, or None if it cannot be revalidated
+    if not eos.net.is_http_url(url) or not os.path.exists(filename):
+        return None
+    validators = eos.json.read_file(_get_validators_filename(filename))
+    if not isinstance(validators, dict) or validators.get("url", None) != url:
+        return None
+    if validators.get("Content-Length", None) != str(os.path.getsize(filename)):
+        return {"url": url}  # the cached file is not what was downloaded; any response counts as modification
+    return validators
+
+
+def _get_partial_validators_filename(partial_filename):
+    return partial_filename + eos.constants.DOWNLOAD_VALIDATORS_SUFFIX
+
+
+def _write_partial_validators(partial_filename, validators):
+    if validators:
+        eos.json.write_file_atomic(_get_partial_validators_filename(partial_filename), validators)
+    else:
+        _remove_file(_get_partial_validators_filename(partial_filename))
+
+
+def _read_partial_validators(partial_filename):
+    validators = eos.json.read_file(_get_partial_validators_filename(partial_filename))
+    return validators if isinstance(validators, dict) else {}
+
+
+def _get_if_range(validators):
+    # If-Range takes a strong ETag, or a date
+    etag = validators.get("ETag", None)
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("Last-Modified", None)
+
+
+def _has_changed(validators, response_validators):
+    # whether the response is of a different version of the file than the one the validators were recorded for
+    return any(response_validators.get(header, None) != value for header, value in validators.items())
+
+
+def _remove_partial_file(partial_filename):
+    _remove_file(partial_filename)
+    _remove_file(_get_partial_validators_filename(partial_filename))
+
+
+def _get_conditional_headers(validators, user_agent):
+    headers = {}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+
+def _is_modified(response, validators):
+    # servers ignoring conditional requests still send the current validators with their full response
+    if response.status == 304:
+        return False
+    if response.status != 200:
+        raise IOError("HTTP error " + str(response.status) + " (" + response.reason + ")")
+    if "Content-Length" not in validators:
+        return True
+    if _get_validators(response) != {
+        header: validators[header] for header in VALIDATOR_HEADERS if header in validators
+    }:
+        return True
+    return response.getheader("Content-Length", validators["Content-Length"]) != validators["Content-Length"]
+
+
+def _download_url_if_modified(url, download_filename, user_agent, validators):
+    # Sends a conditional request for a cached download; if it was modified upstream, the new version replaces the
+    # cached file. Returns whether the file was modified.
+    partial_filename = download_filename + ".part"
+    with eos.net.request(url, _get_conditional_headers(validators, user_agent)) as response:
+        if not _is_modified(response, validators):
+            return False
+        with open(partial_filename, "wb") as f:
+            _write_response(response, f, hashlib.sha1())
+        validators = _get_validators(response)
+    os.replace(partial_filename, download_filename)
+    _write_validators(download_filename, url, validators)
+    return True
+
+
+def is_download_modified(url, dst_dir, user_agent=None):
+    # Checks with a conditional HEAD request whether a cached download without SHA1 hash was modified upstream. Files
+    # that cannot be revalidated count as unmodified, and so do failed checks, like before revalidation existed.
+    url = sanitize_url(url)
+    validators = _read_validators(os.path.join(dst_dir, get_filename_from_url(url)), url)
+    if validators is None:
+        return False
+    try:
+        with eos.net.request(url, _get_conditional_headers(validators, user_agent), method="HEAD") as response:
+            return _is_modified(response, validators)
+    except (IOError, http.client.HTTPException) as e:
+        eos.log_warning("could not revalidate " + url + ": " + str(e))
+        return False
+
+
+def _remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
 def download_scp(hostname, username, path, target_filename):
     if not SCP_AVAILABLE:
         eos.log_error("cannot download via SSH; missing Python packages {paramiko, scp}")
@@ -113,7 +442,23 @@ def download_scp(hostname, username, path, target_filename):
         os.rename(downloaded_filename, target_filename)
 
 
-def download_file(url, dst_dir, sha1_hash_expected=None, user_agent=None):
+def _use_segmented_download(url, partial_filename, segments):
+    # an explicit number of segments (per library) always applies; the global setting only above a size threshold,
+    # which is checked after the initial HEAD request
+    if not eos.net.is_http_url(url) or os.path.exists(partial_filename):
+        return False  # an existing partial download is resumed as a single stream instead
+    if segments is not None:
+        return segments > 1
+    return DOWNLOAD_SEGMENTS > 1
+
+
+def download_file(url, dst_dir, sha1_hash_expected=None, user_agent=None, segments=None):
+    with eos.trace.span("download_file", "download", url=url) as trace_args:
+        return _download_file(url, dst_dir, sha1_hash_expected, user_agent, segments, trace_args)
+
+
+def _download_file(url, dst_dir, sha1_hash_expected, user_agent, segments, trace_args):
+    # trace_args receives where the file came from ('cache'), and its size in bytes
     if not os.path.isdir(dst_dir):
         os.makedirs(dst_dir)
 
@@ -127,36 +472,85 @@ def download_file(url, dst_dir, sha1_hash_expected=None, user_agent=None):
     # in case file already exists, try to check hash
     if os.path.exists(download_filename):
         if not sha1_hash_expected or sha1_hash_expected == "":
+            # file exists, but we have no SHA1 hash to check; revalidate it with the server, if possible
+            validators = _read_validators(download_filename, url)
+            try:
+                if validators is not None and _download_url_if_modified(url, download_filename, user_agent, validators):
+                    eos.log_verbose("File " + download_filename + " was modified upstream; downloaded again")
+                    trace_args["cache"] = "miss"
+                    trace_args["bytes"] = os.path.getsize(download_filename)
+                    return download_filename
+            except (IOError, http.client.HTTPException) as e:
+                eos.log_warning("could not revalidate " + url + ": " + str(e) + "; using the downloaded file")
+                _remove_file(download_filename + ".part")
             eos.log_verbose("File " + download_filename + " already downloaded")
-            return download_filename  # file exists, but we have no SHA1 hash to check, so just return successfully
+            trace_args["cache"] = "local" if validators is None else "revalidated"
+            return download_filename
 
-        hash_current = _compute_sha1_hash(download_filename)
+        hash_current = eos.cache.get_verified_hash(download_filename)
+        if hash_current is None:
+            hash_current = compute_sha1_hash(download_filename)
         if hash_current == sha1_hash_expected:
             eos.log_verbose("File " + download_filename + " already downloaded")
+            eos.cache.set_verified_hash(download_filename, hash_current)
+            eos.cache.add_to_shared_cache(sha1_hash_expected, download_filename)
+            trace_args["cache"] = "local"
+            trace_args["bytes"] = os.path.getsize(download_filename)
             return download_filename  # everything matches; return successfully
         eos.log_warning("hash mismatch: " + hash_current + " (current) vs. " + sha1_hash_expected + " (expected)")
 
-    # download file
+    # try the shared cache before going to the network
+    if sha1_hash_expected and eos.cache.fetch_from_shared_cache(sha1_hash_expected, download_filename):
+        eos.log_verbose("File " + download_filename + " taken from shared cache")
+        eos.cache.set_verified_hash(download_filename, sha1_hash_expected)
+        trace_args["cache"] = "shared"
+        trace_args["bytes"] = os.path.getsize(download_filename)
+        return download_filename
+
+    # download file; it is written to a '.part' file first, and only moved into place after the hash check
     eos.log_verbose("Downloading " + url + " to " + download_filename)
+    partial_filename = download_filename + ".part"
+    trace_args["cache"] = "miss"
+    validators = {} if not sha1_hash_expected and eos.net.is_http_url(url) else None
 
     try:
         if p.scheme == "ssh":
-            download_scp(p.hostname, p.username, p.path, download_filename)
+            download_scp(p.hostname, p.username, p.path, partial_filename)
+            hash_current = None
+        elif _use_segmented_download(url, partial_filename, segments) and _download_url_segmented(
+            url,
+            partial_filename,
+            user_agent,
+            segments or DOWNLOAD_SEGMENTS,
+            threshold=0 if segments else DOWNLOAD_SEGMENTS_THRESHOLD,
+            validators=validators,
+        ):
+            hash_current = None
         else:
-            if user_agent:
-                _MyURLOpener.version = user_agent
-                _MyURLOpener().retrieve(url, download_filename)
-            else:
-                urllib.request.urlretrieve(url, download_filename)
-    except IOError:
-        eos.log_error("retrieving file from " + url + " as '" + download_filename + "' failed")
+            hash_current = _download_url(url, partial_filename, user_agent, validators)
+            if hash_current is None:
+                hash_current = _download_url(url, partial_filename, user_agent, validators)
+    except (IOError, http.client.HTTPException) as e:
+        # a partially downloaded file is kept, such that the download can be resumed on the next run
+        eos.log_error("retrieving file from " + url + " as '" + download_filename + "' failed: " + str(e))
         return ""
 
     # check SHA1 hash
     if sha1_hash_expected and sha1_hash_expected != "":
-        hash_current = _compute_sha1_hash(download_filename)
+        if hash_current is None:
+            hash_current = compute_sha1_hash(partial_filename)
         if hash_current != sha1_hash_expected:
             eos.log_error("hash mismatch: " + hash_current + " (current) vs. " + sha1_hash_expected + " (expected)")
+            _remove_partial_file(partial_filename)
             return ""
 
+    os.replace(partial_filename, download_filename)
+    _remove_file(_get_partial_validators_filename(partial_filename))
+    trace_args["bytes"] = os.path.getsize(download_filename)
+    if validators is not None:
+        _write_validators(download_filename, url, validators)
+    if hash_current is not None:
+        eos.cache.set_verified_hash(download_filename, hash_current)
+    if sha1_hash_expected:
+        eos.cache.add_to_shared_cache(sha1_hash_expected, download_filename)
     return download_filename
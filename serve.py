@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+import eos
+import eos.constants
+import eos.server
+
+
+def main(argv):
+    # parse command line arguments
+    cl_parser = argparse.ArgumentParser(
+        description="Serve the archives and snapshots of a bootstrapping directory, for use as fallback URL"
+    )
+    cl_parser.add_argument(
+        "-b", "--bind", default="", help="specifies the address to listen on (default: all interfaces)"
+    )
+    cl_parser.add_argument(
+        "--port",
+        type=int,
+        default=eos.constants.SERVE_PORT,
+        help="specifies the port to listen on (default: " + str(eos.constants.SERVE_PORT) + ")",
+    )
+    cl_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        help="verbose output; with -v, each request is logged",
+    )
+    cl_parser.add_argument("directory", nargs=1, help="bootstrapping (i.e. destination) directory to serve")
+    cl_args = cl_parser.parse_args(argv)
+
+    eos.set_verbosity(0 if cl_args.verbose is None else cl_args.verbose)
+
+    return eos.server.serve(cl_args.directory[0], cl_args.bind, cl_args.port)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+# A local HTTP server for the download tests: serves one file in changing versions, with ETag validators, byte ranges
+# and If-Range like a regular server, and can misbehave on request (closing the connection early, ignoring If-Range,
+# sending no validators, not supporting ranges). All requests are recorded.
+
+import hashlib
+import http.server
+import threading
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def _respond(self, send_body):
+        fixture = self.server.fixture
+        with fixture.lock:
+            fixture.requests.append((self.command, dict(self.headers)))
+            data, etag = fixture.data, fixture.etag
+            truncate = fixture.truncate_next if send_body else None
+            if send_body:
+                fixture.truncate_next = None
+
+        byte_range = self._get_range(fixture, len(data), etag)
+        if byte_range is None:
+            self.send_response(200)
+            start, end = 0, len(data) - 1
+        else:
+            self.send_response(206)
+            start, end = byte_range
+            self.send_header("Content-Range", "bytes " + str(start) + "-" + str(end) + "/" + str(len(data)))
+        if fixture.send_validators:
+            self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes" if fixture.support_ranges else "none")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if send_body:
+            body = data[start : end + 1]
+            if truncate is not None:
+                self.wfile.write(body[:truncate])
+                self.wfile.flush()
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+            if fixture.after_get:
+                fixture.after_get()
+
+    def _get_range(self, fixture, size, etag):
+        range_header = self.headers.get("Range", None)
+        if not range_header or not fixture.support_ranges:
+            return None
+        if_range = self.headers.get("If-Range", None)
+        if if_range is not None and if_range != etag and not fixture.ignore_if_range:
+            return None  # the file changed; the whole file is sent
+        start, _, end = range_header[len("bytes=") :].partition("-")
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients closing connections early, on purpose
+
+
+class FileServer(object):
+    def __init__(self, data):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.truncate_next = None  # number of bytes after which the next GET closes the connection
+        self.ignore_if_range = False
+        self.send_validators = True
+        self.support_ranges = True
+        self.after_get = None  # called after each GET response
+        self.publish(data)
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.fixture = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def publish(self, data):
+        with self.lock:
+            self.data = data
+            self.etag = '"' + hashlib.sha1(data).hexdigest()[:16] + '"'
+
+    def get_url(self, filename="file.bin"):
+        return "http://127.0.0.1:" + str(self.server.server_address[1]) + "/" + filename
+
+    def get_requests(self, command="GET"):
+        with self.lock:
+            return [headers for method, headers in self.requests if method == command]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Tests of resumable downloads (eos.util.download_file) against a local server: interrupted downloads are kept and
+# resumed with If-Range, and a file republished in between is downloaded again as a whole instead of being spliced.
+#
+#   python -m unittest discover test
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos
+import eos.util
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import http_fixture
+
+OLD_DATA = bytes(range(256)) * 400
+NEW_DATA = bytes(reversed(range(256))) * 400
+TRUNCATED_SIZE = 40000
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+        self.dst_dir = tempfile.mkdtemp(prefix="eos_download_test.")
+        self.server = http_fixture.FileServer(OLD_DATA)
+        self.url = self.server.get_url()
+        self.filename = os.path.join(self.dst_dir, "file.bin")
+        self.partial_filename = self.filename + ".part"
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dst_dir, ignore_errors=True)
+        eos.set_verbosity(0)
+
+    def _download(self, sha1_hash=None):
+        return eos.util.download_file(self.url, self.dst_dir, sha1_hash)
+
+    def _interrupt_download(self, sha1_hash=None):
+        # the server closes the connection after part of the file
+        self.server.truncate_next = TRUNCATED_SIZE
+        self.assertEqual(self._download(sha1_hash), "")
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(os.path.getsize(self.partial_filename), TRUNCATED_SIZE)
+
+    def _read(self, filename):
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertFalse(os.path.exists(self.partial_filename))
+        self.assertFalse(eos.util.is_download_modified(self.url, self.dst_dir))
+
+    def test_truncated_body_is_resumed(self):
+        self._interrupt_download()
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        resume_request = self.server.get_requests()[-1]
+        self.assertEqual(resume_request["Range"], "bytes=" + str(TRUNCATED_SIZE) + "-")
+        self.assertEqual(resume_request["If-Range"], self.server.etag)
+
+    def test_truncated_body_with_sha1_is_resumed(self):
+        sha1_hash = hashlib.sha1(OLD_DATA).hexdigest()
+        self._interrupt_download(sha1_hash)
+        self.assertEqual(self._download(sha1_hash), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertIn("Range", self.server.get_requests()[-1])
+
+    def test_resume_of_republished_file(self):
+        self._interrupt_download()
+        self.server.publish(NEW_DATA)
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), NEW_DATA)
+        self.assertFalse(eos.util.is_download_modified(self.url, self.dst_dir))
+
+    def test_resume_of_republished_file_ignoring_if_range(self):
+        # a 206 of a different version is detected by its validators
+        self._interrupt_download()
+        self.server.publish(NEW_DATA)
+        self.server.ignore_if_range = True
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), NEW_DATA)
+
+    def test_partial_download_without_validators_is_discarded(self):
+        with open(self.partial_filename, "wb") as f:
+            f.write(OLD_DATA[:TRUNCATED_SIZE])
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertNotIn("Range", self.server.get_requests()[-1])
+
+    def test_partial_download_without_validators_with_sha1_is_resumed(self):
+        with open(self.partial_filename, "wb") as f:
+            f.write(OLD_DATA[:TRUNCATED_SIZE])
+        self.assertEqual(self._download(hashlib.sha1(OLD_DATA).hexdigest()), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(self.server.get_requests()[-1]["Range"], "bytes=" + str(TRUNCATED_SIZE) + "-")
+
+    def test_revalidation(self):
+        self._download()
+        self.server.publish(NEW_DATA)
+        self.assertTrue(eos.util.is_download_modified(self.url, self.dst_dir))
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), NEW_DATA)
+        self.assertFalse(eos.util.is_download_modified(self.url, self.dst_dir))
+
+    def test_truncated_revalidation_keeps_the_downloaded_file(self):
+        self._download()
+        self.server.publish(NEW_DATA)
+        self.server.truncate_next = TRUNCATED_SIZE
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertFalse(os.path.exists(self.partial_filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
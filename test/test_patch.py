@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Differential test of eos.patch against GNU patch: random file trees are diffed (with 'diff -rN' at different context
+# sizes, and 'git diff'), the patch is applied to a copy of the original tree by both, and the results are compared.
+# Whenever eos.patch applies a patch in-process, 'patch' has to succeed with the same result; when it leaves the patch
+# to 'patch', it must not have changed anything.
+#
+#   python -m unittest discover test
+#
+# EOS_PATCH_TEST_CASES sets the number of cases (default 300), EOS_PATCH_TEST_SEED the random seed (default 0).
+
+import filecmp
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos.patch
+
+CASES = int(os.environ.get("EOS_PATCH_TEST_CASES", "300"))
+SEED = int(os.environ.get("EOS_PATCH_TEST_SEED", "0"))
+
+# lines with trailing whitespace, tabs and carriage returns, from a small alphabet such that hunks can match elsewhere
+LINE_CHOICES = ["a", "b", "c", "", "x y", "tab\t", "cr\r"]
+DIFF_CONTEXT_OPTIONS = ["-U0", "-U1", "-U3", "-U5"]
+
+
+def _random_lines(rng, count):
+    return [rng.choice(LINE_CHOICES) + str(rng.randint(0, 5)) for _ in range(count)]
+
+
+def _mutate_lines(rng, lines):
+    lines = list(lines)
+    for _ in range(rng.randint(0, 4)):
+        operation = rng.randint(0, 2)
+        index = rng.randint(0, len(lines))
+        if operation == 0:
+            lines[index:index] = _random_lines(rng, rng.randint(1, 3))
+        elif operation == 1 and lines:
+            del lines[index : index + rng.randint(1, 3)]
+        elif lines:
+            lines[min(index, len(lines) - 1)] = "changed" + str(rng.randint(0, 9))
+    return lines
+
+
+def _write_lines(filename, lines, final_newline):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w", newline="") as f:
+        f.write("\n".join(lines) + ("\n" if final_newline and lines else ""))
+
+
+def _create_trees(rng, old_dir, new_dir):
+    # some files are created or deleted, the others changed; files may lack a newline at the end, before and after
+    os.makedirs(old_dir)
+    os.makedirs(new_dir)
+    for index in range(rng.randint(1, 4)):
+        name = rng.choice(["f" + str(index) + ".txt", os.path.join("sub", "f" + str(index) + ".txt")])
+        lines = _random_lines(rng, rng.randint(0, 30))
+        kind = rng.random()
+        if kind < 0.1:
+            _write_lines(os.path.join(new_dir, name), lines, True)
+        elif kind < 0.2:
+            _write_lines(os.path.join(old_dir, name), lines, True)
+        else:
+            _write_lines(os.path.join(old_dir, name), lines, rng.random() < 0.8)
+            _write_lines(os.path.join(new_dir, name), _mutate_lines(rng, lines), rng.random() < 0.8)
+
+
+def _create_patch(rng, work_dir):
+    # returns the patch data and its -p level
+    if shutil.which("git") and rng.random() < 0.5:
+        command = ["git", "diff", "--no-index", "--no-color", "lib", "lib_patched"]
+        data = subprocess.run(command, cwd=work_dir, stdout=subprocess.PIPE).stdout
+        return data.replace(b"a/lib/", b"a/").replace(b"b/lib_patched/", b"b/"), 1
+    command = ["diff", "-rN", rng.choice(DIFF_CONTEXT_OPTIONS), "./lib", "./lib_patched"]
+    return subprocess.run(command, cwd=work_dir, stdout=subprocess.PIPE).stdout, 2
+
+
+def _perturb_tree(rng, tree_dir, new_dir):
+    # lines added at the top of each file make the hunks apply at an offset; a patched tree makes them not apply
+    if rng.random() < 0.3:
+        for root, _, filenames in os.walk(tree_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                with open(path, "rb") as f:
+                    data = f.read()
+                with open(path, "wb") as f:
+                    f.write(b"shift1\nshift2\n" + data)
+    if rng.random() < 0.05:
+        shutil.rmtree(tree_dir)
+        shutil.copytree(new_dir, tree_dir)
+
+
+def _get_tree_difference(dir_a, dir_b):
+    # returns a description of the first difference of the trees, or None if they are equal; the backup and reject
+    # files of 'patch' are ignored
+    ignored = [name for name in os.listdir(dir_b) if name.endswith((".orig", ".rej"))]
+    comparison = filecmp.dircmp(dir_a, dir_b, ignore=ignored)
+    if comparison.left_only or comparison.right_only or comparison.funny_files:
+        return "different files in " + dir_a + ": " + str(comparison.left_only + comparison.right_only)
+    for name in comparison.common_files:
+        if not filecmp.cmp(os.path.join(dir_a, name), os.path.join(dir_b, name), shallow=False):
+            return "different contents of " + os.path.join(dir_a, name)
+    for name in comparison.common_dirs:
+        difference = _get_tree_difference(os.path.join(dir_a, name), os.path.join(dir_b, name))
+        if difference:
+            return difference
+    return None
+
+
+@unittest.skipUnless(shutil.which("patch") and shutil.which("diff"), "'patch' and 'diff' are required")
+class PatchDifferentialTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="eos_patch_test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _run_case(self, rng):
+        # returns whether eos.patch applied the patch in-process
+        case_dir = os.path.join(self.work_dir, "case")
+        shutil.rmtree(case_dir, ignore_errors=True)
+        old_dir = os.path.join(case_dir, "lib")
+        new_dir = os.path.join(case_dir, "lib_patched")
+        _create_trees(rng, old_dir, new_dir)
+        data, pnum = _create_patch(rng, case_dir)
+        if not data:
+            return False
+        patch_file = os.path.join(case_dir, "p.patch")
+        with open(patch_file, "wb") as f:
+            f.write(data)
+
+        eos_dir = os.path.join(case_dir, "eos")
+        gnu_dir = os.path.join(case_dir, "gnu")
+        shutil.copytree(old_dir, eos_dir)
+        _perturb_tree(rng, eos_dir, new_dir)
+        shutil.copytree(eos_dir, gnu_dir)
+        shutil.copytree(eos_dir, os.path.join(case_dir, "unpatched"))
+
+        command = ["patch", "-s", "-d", gnu_dir, "-p" + str(pnum), "-F0", "-i", patch_file]
+        gnu = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        applied = eos.patch.apply_patch_file(eos_dir, patch_file, pnum)
+        if applied:
+            self.assertEqual(
+                gnu.returncode, 0, "'patch' failed where eos.patch applied:\n" + data.decode(errors="replace")
+            )
+            self.assertIsNone(_get_tree_difference(eos_dir, gnu_dir), data.decode(errors="replace"))
+        else:
+            self.assertIsNone(_get_tree_difference(eos_dir, os.path.join(case_dir, "unpatched")))
+        return applied
+
+    def test_matches_gnu_patch(self):
+        rng = random.Random(SEED)
+        applied = 0
+        for case in range(CASES):
+            with self.subTest(case=case, seed=SEED):
+                applied += self._run_case(rng)
+        # most patches are applied in-process; otherwise the comparison tests nothing
+        self.assertGreater(applied, CASES // 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Tests of eos.scheduler: topological ordering of libraries by their dependencies (keeping the original order where
+# possible, and failing on cycles), and running a function over them, sequentially and in parallel, such that a failed
+# library is never followed by a call for any library depending on it.
+#
+#   python -m unittest discover test
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos
+import eos.scheduler
+
+# 'app' depends on 'mid', which depends on 'base'; 'other' is independent, 'leaf' depends on 'app'
+DEPENDENCIES = {"app": ["mid", "base"], "mid": ["base"], "base": [], "other": [], "leaf": ["app"]}
+
+
+def _assert_order(test, names, dependencies):
+    position = {name: index for index, name in enumerate(names)}
+    for name in names:
+        for dependency in dependencies.get(name, []):
+            if dependency in position:
+                test.assertLess(position[dependency], position[name], name + " before its dependency " + dependency)
+
+
+class SortTopologicallyTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+
+    def tearDown(self):
+        eos.set_verbosity(0)
+
+    def test_ordering(self):
+        names = ["leaf", "app", "other", "mid", "base"]
+        sorted_names = eos.scheduler.sort_topologically(names, DEPENDENCIES)
+        self.assertEqual(sorted(sorted_names), sorted(names))
+        _assert_order(self, sorted_names, DEPENDENCIES)
+
+    def test_original_order_is_kept(self):
+        names = ["other", "base", "mid"]
+        self.assertEqual(eos.scheduler.sort_topologically(names, DEPENDENCIES), names)
+        self.assertEqual(eos.scheduler.sort_topologically(["b", "a"], {}), ["b", "a"])
+
+    def test_unknown_dependencies_are_ignored(self):
+        self.assertEqual(eos.scheduler.sort_topologically(["app"], DEPENDENCIES), ["app"])
+        self.assertEqual(eos.scheduler.sort_topologically(["a"], {"a": ["missing"]}), ["a"])
+
+    def test_cycles(self):
+        self.assertIsNone(eos.scheduler.sort_topologically(["a"], {"a": ["a"]}))
+        self.assertIsNone(eos.scheduler.sort_topologically(["a", "b"], {"a": ["b"], "b": ["a"]}))
+        dependencies = {"x": ["a"], "a": ["b"], "b": ["c"], "c": ["a"]}
+        self.assertIsNone(eos.scheduler.sort_topologically(["x", "a", "b", "c"], dependencies))
+
+    def test_long_chain(self):
+        # deeper than the recursion limit
+        count = 20000
+        names = ["lib" + str(index) for index in range(count)]
+        dependencies = {names[index]: [names[index + 1]] for index in range(count - 1)}
+        self.assertEqual(eos.scheduler.sort_topologically(names, dependencies), list(reversed(names)))
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+        self.names = eos.scheduler.sort_topologically(list(DEPENDENCIES), DEPENDENCIES)
+        self.lock = threading.Lock()
+        self.finished = []
+
+    def tearDown(self):
+        eos.set_verbosity(0)
+
+    def _function(self, failing):
+        # records the calls, checking that the dependencies of each name have finished before
+        def function(name):
+            with self.lock:
+                for dependency in DEPENDENCIES[name]:
+                    self.assertIn(dependency, self.finished, name + " started before " + dependency)
+                self.finished.append(name)
+            return name not in failing
+
+        return function
+
+    def _run(self, jobs, failing=()):
+        return dict(eos.scheduler.run(self.names, DEPENDENCIES, self._function(failing), jobs=jobs))
+
+    def test_all_succeed(self):
+        for jobs in [1, 4]:
+            with self.subTest(jobs=jobs):
+                self.finished = []
+                results = self._run(jobs)
+                self.assertEqual(results, {name: True for name in DEPENDENCIES})
+                self.assertEqual(sorted(self.finished), sorted(DEPENDENCIES))
+
+    def test_failure_propagates_to_dependents(self):
+        for jobs in [1, 4]:
+            with self.subTest(jobs=jobs):
+                self.finished = []
+                results = self._run(jobs, failing=["mid"])
+                self.assertEqual(results["base"], True)
+                self.assertEqual(results["other"], True)
+                self.assertEqual(results["mid"], False)
+                self.assertIsNone(results["app"])
+                self.assertIsNone(results["leaf"])
+                self.assertNotIn("app", self.finished)
+                self.assertNotIn("leaf", self.finished)
+
+    def test_parallel_runs_independent_names_concurrently(self):
+        # both functions wait for each other; this only finishes if they run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+
+        def function(name):
+            barrier.wait()
+            return True
+
+        results = dict(eos.scheduler.run(["a", "b"], {}, function, jobs=2))
+        self.assertEqual(results, {"a": True, "b": True})
+
+    def test_results_after_dependencies(self):
+        yielded = [name for name, _ in eos.scheduler.run(self.names, DEPENDENCIES, self._function(()), jobs=4)]
+        self.assertEqual(sorted(yielded), sorted(DEPENDENCIES))
+        _assert_order(self, yielded, DEPENDENCIES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Tests of segmented downloads (eos.util.download_file with segments) against a local server: the byte ranges are
+# assembled into the complete file, and a file republished during the download falls back to a single stream instead
+# of mixing segments of both versions.
+#
+#   python -m unittest discover test
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos
+import eos.util
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import http_fixture
+
+# a size that is not a multiple of the number of segments
+OLD_DATA = bytes(range(256)) * 390 + b"end"
+NEW_DATA = bytes(reversed(range(256))) * 390 + b"END"
+SEGMENTS = 7
+
+
+class SegmentedDownloadTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+        self.dst_dir = tempfile.mkdtemp(prefix="eos_segmented_download_test.")
+        self.server = http_fixture.FileServer(OLD_DATA)
+        self.url = self.server.get_url()
+        self.filename = os.path.join(self.dst_dir, "file.bin")
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dst_dir, ignore_errors=True)
+        eos.util.set_download_segments(1, 64 * 1024 * 1024)
+        eos.set_verbosity(0)
+
+    def _download(self, sha1_hash=None, segments=SEGMENTS):
+        return eos.util.download_file(self.url, self.dst_dir, sha1_hash, segments=segments)
+
+    def _read(self, filename):
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def _get_range_requests(self):
+        return [headers for headers in self.server.get_requests() if "Range" in headers]
+
+    def test_segments_are_assembled(self):
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertFalse(os.path.exists(self.filename + ".part"))
+        range_requests = self._get_range_requests()
+        self.assertEqual(len(range_requests), SEGMENTS)
+        self.assertEqual(len(self.server.get_requests()), SEGMENTS)
+        for headers in range_requests:
+            self.assertEqual(headers["If-Range"], self.server.etag)
+        self.assertFalse(eos.util.is_download_modified(self.url, self.dst_dir))
+
+    def test_segments_with_sha1_are_assembled(self):
+        self.assertEqual(self._download(hashlib.sha1(OLD_DATA).hexdigest()), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(len(self._get_range_requests()), SEGMENTS)
+
+    def test_republished_during_download(self):
+        # the server switches to the new version after the first segment; no segment of the old version may remain
+        def republish():
+            self.server.after_get = None
+            self.server.publish(NEW_DATA)
+
+        self.server.after_get = republish
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), NEW_DATA)
+        self.assertNotIn("Range", self.server.get_requests()[-1])
+        self.assertFalse(eos.util.is_download_modified(self.url, self.dst_dir))
+
+    def test_republished_during_download_ignoring_if_range(self):
+        # a 206 of a different version is detected by its validators
+        def republish():
+            self.server.after_get = None
+            self.server.publish(NEW_DATA)
+
+        self.server.after_get = republish
+        self.server.ignore_if_range = True
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), NEW_DATA)
+
+    def test_no_validators_without_sha1_uses_single_stream(self):
+        self.server.send_validators = False
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(self._get_range_requests(), [])
+
+    def test_no_validators_with_sha1_is_segmented(self):
+        self.server.send_validators = False
+        self.assertEqual(self._download(hashlib.sha1(OLD_DATA).hexdigest()), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(len(self._get_range_requests()), SEGMENTS)
+
+    def test_no_range_support_uses_single_stream(self):
+        self.server.support_ranges = False
+        self.assertEqual(self._download(), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(self._get_range_requests(), [])
+
+    def test_global_segments_threshold(self):
+        eos.util.set_download_segments(4, threshold=len(OLD_DATA) + 1)
+        self.assertEqual(self._download(segments=None), self.filename)
+        self.assertEqual(self._get_range_requests(), [])
+        os.remove(self.filename)
+        eos.util.set_download_segments(4, threshold=len(OLD_DATA))
+        self.assertEqual(self._download(segments=None), self.filename)
+        self.assertEqual(self._read(self.filename), OLD_DATA)
+        self.assertEqual(len(self._get_range_requests()), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Tests of the cache server (eos.server): parsing of Range headers, and requests to a server on a temporary
+# bootstrapping directory for byte ranges, If-Range, ETag revalidation (304), and the files that are not served.
+#
+#   python -m unittest discover test
+
+import http.client
+import http.server
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos
+import eos.server
+
+DATA = bytes(range(256)) * 40
+ARCHIVE_PATH = "/.cache/archives/lib/lib.tar.gz"
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_single_ranges(self):
+        self.assertEqual(eos.server._parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(eos.server._parse_range("bytes=100-", 1000), (100, 999))
+        self.assertEqual(eos.server._parse_range("bytes=900-2000", 1000), (900, 999))
+        self.assertEqual(eos.server._parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(eos.server._parse_range("bytes=-2000", 1000), (0, 999))
+
+    def test_unsatisfiable_ranges(self):
+        self.assertIs(eos.server._parse_range("bytes=1000-", 1000), False)
+        self.assertIs(eos.server._parse_range("bytes=500-100", 1000), False)
+        self.assertIs(eos.server._parse_range("bytes=-0", 1000), False)
+        self.assertIs(eos.server._parse_range("bytes=0-", 0), False)
+
+    def test_unsupported_ranges(self):
+        # the whole file is sent for these
+        self.assertIsNone(eos.server._parse_range(None, 1000))
+        self.assertIsNone(eos.server._parse_range("", 1000))
+        self.assertIsNone(eos.server._parse_range("bytes=0-9,20-29", 1000))
+        self.assertIsNone(eos.server._parse_range("items=0-9", 1000))
+        self.assertIsNone(eos.server._parse_range("bytes=a-b", 1000))
+
+
+class ServedPathTest(unittest.TestCase):
+    def test_served_paths(self):
+        self.assertTrue(eos.server._is_served_path("."))
+        self.assertTrue(eos.server._is_served_path(".cache"))
+        self.assertTrue(eos.server._is_served_path(".cache/archives/lib/lib.tar.gz"))
+        self.assertTrue(eos.server._is_served_path(".cache/snapshots/lib/lib.tar"))
+
+    def test_not_served_paths(self):
+        self.assertFalse(eos.server._is_served_path("lib/CMakeLists.txt"))
+        self.assertFalse(eos.server._is_served_path(".cache/pristine/lib"))
+        self.assertFalse(eos.server._is_served_path(".cache/archives/lib/lib.tar.gz.part"))
+        self.assertFalse(eos.server._is_served_path(".cache/archives/lib/lib.tar.gz.part.validators.json"))
+        self.assertFalse(eos.server._is_served_path(".cache/snapshots/lib/lib.tar.tmp"))
+
+
+class CacheServerTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+        self.directory = tempfile.mkdtemp(prefix="eos_server_test.")
+        archive_dir = os.path.join(self.directory, ".cache", "archives", "lib")
+        os.makedirs(archive_dir)
+        os.makedirs(os.path.join(self.directory, "lib"))
+        self.archive_filename = os.path.join(archive_dir, "lib.tar.gz")
+        with open(self.archive_filename, "wb") as f:
+            f.write(DATA)
+        with open(self.archive_filename + ".part", "wb") as f:
+            f.write(DATA[:100])
+        with open(os.path.join(self.directory, "lib", "CMakeLists.txt"), "wb") as f:
+            f.write(b"project(lib)\n")
+
+        def create_handler(*args, **kwargs):
+            return eos.server.CacheRequestHandler(*args, directory=self.directory, **kwargs)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), create_handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        eos.set_verbosity(0)
+
+    def _request(self, path, headers=None, method="GET"):
+        # returns the response and its body; the connection is kept alive across requests
+        self.connection.request(method, path, headers=headers or {})
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_whole_file(self):
+        response, body = self._request(ARCHIVE_PATH)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, DATA)
+        self.assertEqual(response.getheader("Accept-Ranges"), "bytes")
+        self.assertTrue(response.getheader("ETag"))
+        self.assertTrue(response.getheader("Last-Modified"))
+
+    def test_head(self):
+        response, body = self._request(ARCHIVE_PATH, method="HEAD")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b"")
+        self.assertEqual(response.getheader("Content-Length"), str(len(DATA)))
+
+    def test_byte_ranges(self):
+        response, body = self._request(ARCHIVE_PATH, {"Range": "bytes=10-19"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, DATA[10:20])
+        self.assertEqual(response.getheader("Content-Range"), "bytes 10-19/" + str(len(DATA)))
+        response, body = self._request(ARCHIVE_PATH, {"Range": "bytes=-5"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, DATA[-5:])
+        # a request without range on the same connection gets the whole file again
+        response, body = self._request(ARCHIVE_PATH)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, DATA)
+
+    def test_unsatisfiable_range(self):
+        response, body = self._request(ARCHIVE_PATH, {"Range": "bytes=" + str(len(DATA)) + "-"})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader("Content-Range"), "bytes */" + str(len(DATA)))
+        self.assertEqual(body, b"")
+
+    def test_if_range(self):
+        etag = self._request(ARCHIVE_PATH, method="HEAD")[0].getheader("ETag")
+        response, body = self._request(ARCHIVE_PATH, {"Range": "bytes=100-", "If-Range": etag})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, DATA[100:])
+        response, body = self._request(ARCHIVE_PATH, {"Range": "bytes=100-", "If-Range": '"other"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, DATA)
+
+    def test_if_none_match(self):
+        etag = self._request(ARCHIVE_PATH, method="HEAD")[0].getheader("ETag")
+        response, body = self._request(ARCHIVE_PATH, {"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader("ETag"), etag)
+        self.assertEqual(body, b"")
+        response, body = self._request(ARCHIVE_PATH, {"If-None-Match": '"other", ' + etag})
+        self.assertEqual(response.status, 304)
+
+    def test_changed_file_is_modified(self):
+        etag = self._request(ARCHIVE_PATH, method="HEAD")[0].getheader("ETag")
+        with open(self.archive_filename, "ab") as f:
+            f.write(b"more")
+        response, body = self._request(ARCHIVE_PATH, {"If-None-Match": etag})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, DATA + b"more")
+        self.assertNotEqual(response.getheader("ETag"), etag)
+
+    def test_not_served_files(self):
+        for path in [ARCHIVE_PATH + ".part", "/lib/CMakeLists.txt", "/.cache/archives/lib/missing.tar.gz"]:
+            response, _ = self._request(path)
+            self.assertEqual(response.status, 404, path)
+
+    def test_listing_hides_partial_files(self):
+        response, body = self._request("/.cache/archives/lib/")
+        self.assertEqual(response.status, 200)
+        self.assertIn(b"lib.tar.gz", body)
+        self.assertNotIn(b".part", body)
+        response, body = self._request("/")
+        self.assertIn(b".cache/", body)
+        self.assertNotIn(b"lib/", body)
+
+    def test_serve_on_used_port(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            s.listen(1)
+            self.assertEqual(eos.server.serve(self.directory, "127.0.0.1", s.getsockname()[1]), -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Tests of eos.state: changes are journaled right away, and a run interrupted before the state file is written (e.g. by
+# a crash) leaves a journal that is replayed on the next read, up to an incomplete last entry.
+#
+#   python -m unittest discover test
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import eos
+import eos.state
+
+LIB_A = {"name": "a", "source": {"type": "archive", "url": "http://example.com/a.tar.gz"}}
+LIB_B = {"name": "b", "source": {"type": "git", "url": "http://example.com/b.git", "revision": "v1"}}
+LIB_B2 = {"name": "b", "source": {"type": "git", "url": "http://example.com/b.git", "revision": "v2"}}
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        eos.set_verbosity(-1)
+        self.work_dir = tempfile.mkdtemp(prefix="eos_state_test.")
+        self.filename = os.path.join(self.work_dir, ".bootstrap.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        eos.set_verbosity(0)
+
+    def _read_state(self):
+        state = eos.state.State(self.filename)
+        state.read()
+        return state
+
+    def _read_state_file(self):
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def test_write(self):
+        state = self._read_state()
+        state.add_library(LIB_A)
+        state.add_library(LIB_B, {"commit": "abc"})
+        state.write()
+        self.assertFalse(os.path.exists(state.journal_filename))
+        self.assertEqual([obj["name"] for obj in self._read_state_file()], ["a", "b"])
+
+        state = self._read_state()
+        self.assertFalse(state.modified)
+        self.assertTrue(state.check_equals("a", LIB_A))
+        self.assertTrue(state.check_equals("b", LIB_B))
+        self.assertFalse(state.check_equals("b", LIB_B2))
+        self.assertEqual(state.get_metadata("b"), {"commit": "abc"})
+        self.assertEqual(state.get_metadata("a"), {})
+
+    def test_replay_after_crash(self):
+        state = self._read_state()
+        state.add_library(LIB_A)
+        state.add_library(LIB_B)
+        state.write()
+
+        # a run that changes the state and is interrupted before writing it
+        state = self._read_state()
+        state.add_library(LIB_B2)
+        state.remove_library("a")
+        self.assertEqual(len(self._read_state_file()), 2)
+
+        state = self._read_state()
+        self.assertTrue(state.modified)
+        self.assertEqual(list(state.libraries), ["b"])
+        self.assertTrue(state.check_equals("b", LIB_B2))
+        state.write()
+        self.assertFalse(os.path.exists(state.journal_filename))
+        self.assertEqual(self._read_state_file(), [LIB_B2])
+
+    def test_replay_without_state_file(self):
+        state = self._read_state()
+        state.add_library(LIB_A)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertTrue(self._read_state().check_equals("a", LIB_A))
+
+    def test_replay_of_clear(self):
+        state = self._read_state()
+        state.add_library(LIB_A)
+        state.write()
+        state = self._read_state()
+        state.clear()
+        state.add_library(LIB_B)
+        self.assertEqual(list(self._read_state().libraries), ["b"])
+
+    def test_incomplete_last_entry_is_ignored(self):
+        state = self._read_state()
+        state.add_library(LIB_A)
+        with open(state.journal_filename, "a") as f:
+            f.write(json.dumps({"op": "add", "library": LIB_B})[:20])
+        state = self._read_state()
+        self.assertEqual(list(state.libraries), ["a"])
+        state.write()
+        self.assertEqual(self._read_state_file(), [LIB_A])
+
+    def test_unmodified_state_is_not_written(self):
+        state = self._read_state()
+        state.remove_library("missing")
+        state.write()
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(state.journal_filename))
+
+
+if __name__ == "__main__":
+    unittest.main()